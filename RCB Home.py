@@ -14,13 +14,17 @@ import secrets
 import requests
 
 from rcb_init import init_page
-from rcb_rag_manager import process_uploaded_documents, show_file_content_dialog, clear_uploaded_content
+from rcb_rag_manager import process_uploaded_documents, show_uploads_dialog, clear_uploaded_content, warm_up_embedding, warm_up_ingest_pool, show_document_manager
 
 if 'vectorstore' not in st.session_state:
     st.session_state.vectorstore = None
 if 'retriever' not in st.session_state:
     st.session_state.retriever = None
 
+# Load the shared embedding model, and start the ingestion workers with their docling converters, once per server process.
+warm_up_embedding()
+warm_up_ingest_pool()
+
 st.set_page_config(
     page_title="Rapid Course Builder (RCB)"
 )
@@ -188,9 +192,9 @@ with st.sidebar:
     st.subheader("RAG Documents Upload")
     uploaded_files = st.file_uploader(
         "Upload Documents for RAG,",
-        type=["pdf", "docx", "xlsx", "pptx", "csv", "asciidoc"],
+        type=["pdf", "docx", "xlsx", "pptx", "csv", "asciidoc", "adoc", "md", "txt", "html", "htm"],
         accept_multiple_files=True,
-        help=f"Upload documents to provide context for the AI. Supported formats: pdf, docx, xlsx, pptx, csv, asciidoc",
+        help=f"Upload documents to provide context for the AI. Supported formats: pdf, docx, xlsx, pptx, csv, asciidoc, markdown, text, html",
         disabled=st.session_state.disable_all
     )
     if uploaded_files:
@@ -214,8 +218,10 @@ with st.sidebar:
         clear_uploads = st.button("Clear uploads")
 
         if view_uploads:
-            show_file_content_dialog(f"{st.session_state.user_dir}/uploads-hash.txt")
+            show_uploads_dialog()
 
         if clear_uploads:
             clear_uploaded_content()
 
+        show_document_manager()
+
@@ -24,6 +24,7 @@ from rcb_rag_manager import retrieve_context
 
 from rcb_github import setup_github_repo, push_to_github, add_github_contributors
 from rcb_llm_manager import call_llm_to_generate_response
+from rcb_trace import trace_span
 
 
 # if 'vectorstore' not in st.session_state:
@@ -180,7 +181,7 @@ if not st.session_state.show_logs: # Hide chat interface if logs are shown
                 print(f"context for course outline {st.session_state.context_for_outline}")
 
                 init_quickcourse_prompts() # Re-initialize prompts to update context and topics
-                st.session_state.ai_generated_topics = call_llm_to_generate_response(st.session_state.model_choice, st.session_state.system_prompt_course_outline, st.session_state.user_prompt_course_outline)
+                st.session_state.ai_generated_topics = call_llm_to_generate_response(st.session_state.model_choice, st.session_state.system_prompt_course_outline, st.session_state.user_prompt_course_outline, task="outline")
                 print("Curated objectives: \n", st.session_state.ai_generated_topics)
                 
         # Display response outside of button click handler so it persists
@@ -223,7 +224,8 @@ if st.session_state.show_logs:
             disabled=True,
             label_visibility="collapsed"
         )
-    generate_antora_yml()
-    push_to_github()
+    with trace_span("quickcourse_build", repo=st.session_state.repo_name):
+        generate_antora_yml()
+        push_to_github()
     st.info("Reload the page to start a new QuickCourse creation process.")
 
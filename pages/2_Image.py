@@ -16,7 +16,8 @@ from langchain_community.llms import Ollama
 from langchain_core.output_parsers import StrOutputParser
 
 from rcb_init import init_page, init_llm_vars, init_image_page
-from rcb_llm_manager import call_llm_to_generate_response
+from rcb_llm_manager import call_llm_to_generate_response, stream_llm_response
+from rcb_trace import trace_span
 
 st.set_page_config(
     page_title="Image using RCB"
@@ -90,7 +91,7 @@ def debug_d2_image_code():
 
 def generate_image_code():
     with st.spinner(f"Generating code for image using {st.session_state.model_choice}..."):
-        st.session_state.d2_image_code = call_llm_to_generate_response(st.session_state.model_choice, st.session_state.system_prompt_generate_image, st.session_state.user_prompt_generate_image)
+        st.session_state.d2_image_code = st.write_stream(stream_llm_response(st.session_state.model_choice, st.session_state.system_prompt_generate_image, st.session_state.user_prompt_generate_image, task="d2_code"))
         print("D2LANG CODE: \n", st.session_state.d2_image_code)
         update_d2_image_code()
 
@@ -105,7 +106,11 @@ def render_image_from_code():
         with open(st.session_state.d2_code_path, "w") as f:
             f.write(st.session_state.d2_image_code)
 
-        st.session_state.image_render_result = subprocess.run (['d2', st.session_state.d2_code_path, st.session_state.d2_image_path], capture_output=True, text=True)
+        with trace_span("d2_render", code_bytes=len(st.session_state.d2_image_code.encode("utf-8"))) as span:
+            st.session_state.image_render_result = subprocess.run (['d2', st.session_state.d2_code_path, st.session_state.d2_image_path], capture_output=True, text=True)
+            span["attrs"]["returncode"] = st.session_state.image_render_result.returncode
+            if os.path.exists(st.session_state.d2_image_path):
+                span["attrs"]["image_bytes"] = os.path.getsize(st.session_state.d2_image_path)
         print(f"Result of d2 command: {st.session_state.image_render_result}")
         if st.session_state.image_render_result.returncode != 0:
             st.button("Debug and Regenerate Code", on_click=debug_d2_image_code)
@@ -10,7 +10,7 @@ import os
 import glob
 from pathlib import Path
 
-from rcb_audio import generate_audio_file_from_transcript
+from rcb_audio import generate_audio_file_from_transcript, generate_audio_files_gemini_tts
 from rcb_init import init_audio_page, init_audio_prompts, init_audio_vars, init_page, init_llm_vars
 
 st.set_page_config(
@@ -183,21 +183,43 @@ def generate_video_from_pptx(uploaded_file):
             notes.append((i, text))
         return notes
 
-    for num, note in extract_notes("input.pptx"):
-        st.session_state.progress_logs.info(f"Extracting notes from slide {num}...")
-        str_num = f"{num:03d}"
-        with open(f"{st.session_state.video_data_dir}/{str_num}.txt", "w") as f:
-            f.write(note)
-        st.session_state.curated_transcript = note
-        st.session_state.audio_file_path_txt = f"{st.session_state.video_data_dir}/{str_num}.txt"
-        st.session_state.audio_file_path_wav = f"{st.session_state.video_data_dir}/{str_num}.wav"
-        st.session_state.audio_file_path_mp3 = f"{st.session_state.video_data_dir}/{str_num}.mp3"
-        st.session_state.progress_logs.info(f"Creating audio file for slide {num} from transcript")
-        print(f"Creating audio file for slide {num} from transcript")
-        generate_audio_file_from_transcript()
-        shutil.copyfile(st.session_state.default_audio_file_path_wav, st.session_state.audio_file_path_wav)
-        shutil.copyfile(st.session_state.default_audio_file_path_mp3, st.session_state.audio_file_path_mp3)
-        shutil.copyfile(st.session_state.default_audio_file_path_txt, st.session_state.audio_file_path_txt)
+    notes = extract_notes("input.pptx")
+    if st.session_state.tts_choice == "GeminiTTS":
+        # Gemini TTS runs for all slides at once on the async client.
+        tts_jobs = []
+        for num, note in notes:
+            st.session_state.progress_logs.info(f"Extracting notes from slide {num}...")
+            str_num = f"{num:03d}"
+            with open(f"{st.session_state.video_data_dir}/{str_num}.txt", "w") as f:
+                f.write(note)
+            tts_jobs.append({
+                "transcript": note,
+                "wav_path": f"{st.session_state.video_data_dir}/{str_num}.wav",
+                "mp3_path": f"{st.session_state.video_data_dir}/{str_num}.mp3",
+            })
+        st.session_state.progress_logs.info(f"Creating audio files for {len(tts_jobs)} slides from transcripts")
+        failed = generate_audio_files_gemini_tts(tts_jobs)
+        if failed:
+            # Slides and audio files are paired by position, a missing mp3 would shift every narration after it.
+            failed_slides = ", ".join(os.path.basename(job["mp3_path"]) for job in failed)
+            st.session_state.progress_logs.error(f"Failed to create audio for {len(failed)} slide(s): {failed_slides}. Video not created, please try again.")
+            return
+    else:
+        for num, note in notes:
+            st.session_state.progress_logs.info(f"Extracting notes from slide {num}...")
+            str_num = f"{num:03d}"
+            with open(f"{st.session_state.video_data_dir}/{str_num}.txt", "w") as f:
+                f.write(note)
+            st.session_state.curated_transcript = note
+            st.session_state.audio_file_path_txt = f"{st.session_state.video_data_dir}/{str_num}.txt"
+            st.session_state.audio_file_path_wav = f"{st.session_state.video_data_dir}/{str_num}.wav"
+            st.session_state.audio_file_path_mp3 = f"{st.session_state.video_data_dir}/{str_num}.mp3"
+            st.session_state.progress_logs.info(f"Creating audio file for slide {num} from transcript")
+            print(f"Creating audio file for slide {num} from transcript")
+            generate_audio_file_from_transcript()
+            shutil.copyfile(st.session_state.default_audio_file_path_wav, st.session_state.audio_file_path_wav)
+            shutil.copyfile(st.session_state.default_audio_file_path_mp3, st.session_state.audio_file_path_mp3)
+            shutil.copyfile(st.session_state.default_audio_file_path_txt, st.session_state.audio_file_path_txt)
 
     st.session_state.progress_logs.info("Slides and notes extracted successfully!")
     simple_video_creator()
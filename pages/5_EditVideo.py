@@ -14,6 +14,7 @@ import subprocess
 from pathlib import Path
 
 from rcb_init import init_page, init_audio_vars
+from rcb_trace import trace_span
 from rcb_edit_video import init_edit_video_page, cleanup_directory_content, process_video_segments, ts_to_seconds, concat_videos
 from moviepy import VideoFileClip, concatenate_videoclips, AudioFileClip, CompositeAudioClip
 import moviepy.video.fx as vfx
@@ -213,7 +214,8 @@ def dub_audio_on_video(
     print("FFmpeg command to dub audio:\n", " ".join(cmd))
     print(f"Target duration: {target_duration:.2f}s")
 
-    subprocess.run(cmd, check=True)
+    with trace_span("ffmpeg", operation="dub_audio", tracks=len(audio_tracks)):
+        subprocess.run(cmd, check=True)
 
     return cmd
 
@@ -2,21 +2,23 @@ import streamlit as st
 from dotenv import load_dotenv
 
 from rcb_init import init_page, init_llm_vars, init_chat_interface_prompts
-from rcb_llm_manager import call_llm_to_generate_response
+from rcb_llm_manager import call_llm_to_generate_response, stream_llm_response
 from rcb_rag_manager import process_uploaded_documents, retrieve_context
 
 def get_ai_response():
     init_chat_interface_prompts()
     try:
-        ai_response = call_llm_to_generate_response(st.session_state.model_choice,st.session_state.system_prompt_chat_interface, st.session_state.user_prompt_chat_interface)
+        st.session_state.chat_container.markdown(":blue-background[🤖 RCB:]")
+        # Show the answer while it is being generated
+        ai_response = st.session_state.chat_container.write_stream(
+            stream_llm_response(st.session_state.model_choice,st.session_state.system_prompt_chat_interface, st.session_state.user_prompt_chat_interface, task="chat")
+        )
         print(f"AI Response: {ai_response}")
         # Add AI response to chat history
         st.session_state.chat_history.append({
             'role': 'RCB',
             'content': ai_response
         })
-        st.session_state.chat_container.info("**RCB:**", icon="🤖", width=100)
-        st.session_state.chat_container.write(f"{ai_response}")
 
         print(f"CHAT HISTORY:\n {st.session_state.chat_history}")
 
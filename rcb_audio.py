@@ -7,7 +7,8 @@ import shutil
 from streamlit import text_input
 
 from rcb_init import init_audio_vars, init_audio_prompts
-from rcb_llm_manager import call_llm_to_generate_response
+from rcb_llm_manager import call_llm_to_generate_response, stream_llm_response, agenerate_gemini_content, run_coroutine, run_coroutines
+from rcb_trace import trace_span
 
 from google import genai
 from google.genai import types
@@ -18,6 +19,9 @@ import struct
 
 from moviepy import AudioFileClip
 
+GEMINI_TTS_MODEL_NAME = "gemini-2.5-flash-preview-tts"
+GEMINI_TTS_SAMPLE_RATE = 24000
+
 def curate_transcript_text():
     #st.session_state.audio_file_name_str = "rcb_generated_audio"
     init_audio_vars()
@@ -29,9 +33,7 @@ def curate_transcript_text():
     with st.spinner("Curating transcript..."):
         # print(f"DEBUG PROVIDED TRANSCRIPT: \n {st.session_state.provided_transcript}")
         # init_audio_prompts()
-        print(f"SYSTEM PROMPT: \n {st.session_state.system_prompt_curate_transcript}")
-        print(f"USER PROMPT: \n {st.session_state.user_prompt_curate_transcript}")
-        response = call_llm_to_generate_response(st.session_state.model_choice,st.session_state.system_prompt_curate_transcript, st.session_state.user_prompt_curate_transcript)
+        response = st.write_stream(stream_llm_response(st.session_state.model_choice,st.session_state.system_prompt_curate_transcript, st.session_state.user_prompt_curate_transcript, task="transcript_curation"))
         print("CURATED TRANSCRIPT: \n", response)
         # st.write(response)
         st.session_state.curated_transcript = response
@@ -85,32 +87,38 @@ def generate_audio_file_from_transcript_piper_tts():
             text_input = f.read()
 
         print(f"st.session_state.default_audio_file_path_wav: {st.session_state.default_audio_file_path_wav}")
-        if st.session_state.voice_type_mf == "Female":
-            result = subprocess.run(
-                ["piper", "-m", "en_US-hfc_female-medium.onnx", "-c", "en_US-hfc_female-medium.onnx.json", "-f", st.session_state.default_audio_file_path_wav],
-                input=text_input,
-                text=True,
-                capture_output=True
-            )
-        if st.session_state.voice_type_mf == "Male":
-            result = subprocess.run(
-                ["piper", "-m", "en_US-danny-low.onnx", "-c", "en_US-danny-low.json", "-f", st.session_state.default_audio_file_path_wav],
-                input=text_input,
-                text=True,
-                capture_output=True
-            )
+        with trace_span("tts", engine="piper", voice=st.session_state.voice_type_mf, text_chars=len(text_input)) as span:
+            if st.session_state.voice_type_mf == "Female":
+                result = subprocess.run(
+                    ["piper", "-m", "en_US-hfc_female-medium.onnx", "-c", "en_US-hfc_female-medium.onnx.json", "-f", st.session_state.default_audio_file_path_wav],
+                    input=text_input,
+                    text=True,
+                    capture_output=True
+                )
+            if st.session_state.voice_type_mf == "Male":
+                result = subprocess.run(
+                    ["piper", "-m", "en_US-danny-low.onnx", "-c", "en_US-danny-low.json", "-f", st.session_state.default_audio_file_path_wav],
+                    input=text_input,
+                    text=True,
+                    capture_output=True
+                )
+            span["attrs"]["returncode"] = result.returncode
+            if os.path.exists(st.session_state.default_audio_file_path_wav):
+                span["attrs"]["audio_bytes"] = os.path.getsize(st.session_state.default_audio_file_path_wav)
 
         #print(f"Result of piper command: {result}")
         if result.returncode != 0:
             st.warning(f"Audio file generation failed due to the following error: \n {result.stderr}")
             return
 
-        result = subprocess.run(
-            ["ffmpeg", "-y", "-i", st.session_state.default_audio_file_path_wav, st.session_state.default_audio_file_path_mp3],
-            input=text_input,
-            text=True,
-            capture_output=True
-        )
+        with trace_span("ffmpeg", operation="wav_to_mp3") as span:
+            result = subprocess.run(
+                ["ffmpeg", "-y", "-i", st.session_state.default_audio_file_path_wav, st.session_state.default_audio_file_path_mp3],
+                input=text_input,
+                text=True,
+                capture_output=True
+            )
+            span["attrs"]["returncode"] = result.returncode
         #print(f"Result of ffmpeg command: {result}")
         if result.returncode != 0:
             st.warning(f"Conversion to mp3 failed: \n {result.stderr}")
@@ -132,69 +140,56 @@ def gemini_tts_wave_file(filename, pcm, channels=1, rate=24000, sample_width=2):
         wf.writeframes(pcm)
 
 
-def generate_audio_file_from_transcript_gemini_tts():
-    print("Generating audio file using Gemini TTS...")
-    client = genai.Client(api_key=st.session_state.gemini_api_key)
-    print(f"st.session_state.default_audio_file_path_txt: {st.session_state.default_audio_file_path_txt}")
-    with open(st.session_state.default_audio_file_path_txt, "r") as f:
-        st.session_state.curated_transcript = f.read()
-    init_audio_prompts()
-    if st.session_state.voice_type_mf == "Female":
-        response = client.models.generate_content(
-        model="gemini-2.5-flash-preview-tts",
-        contents=st.session_state.gemini_tts_prompt,
-        config=types.GenerateContentConfig(
-            response_modalities=["audio"],
-            speech_config=types.SpeechConfig(
-                voice_config=types.VoiceConfig(
-                    prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                    voice_name=st.session_state.gemini_tts_voice_female,
-                    )
-                )
-            ),
-        )
-        )
-        
+def get_gemini_tts_voice_name():
     if st.session_state.voice_type_mf == "Male":
-        response = client.models.generate_content(
-        model="gemini-2.5-flash-preview-tts",
-        contents=st.session_state.gemini_tts_prompt,
-        config=types.GenerateContentConfig(
+        return st.session_state.gemini_tts_voice_male
+    return st.session_state.gemini_tts_voice_female
+
+async def agenerate_gemini_tts(api_key, prompt, voice_name):
+    """Synthesize prompt with Gemini TTS, returns the raw PCM data."""
+    response = await agenerate_gemini_content(
+        api_key,
+        GEMINI_TTS_MODEL_NAME,
+        prompt,
+        types.GenerateContentConfig(
             response_modalities=["audio"],
             speech_config=types.SpeechConfig(
                 voice_config=types.VoiceConfig(
                     prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                    voice_name=st.session_state.gemini_tts_voice_male,
+                    voice_name=voice_name,
                     )
                 )
             ),
-        )
-        )
-
-    # Debug the response structure
-    print("\nResponse structure:")
-    print(f"Number of candidates: {len(response.candidates)}")
-    print(f"Content parts: {len(response.candidates[0].content.parts)}")
-    print(f"Part type: {type(response.candidates[0].content.parts[0])}")
-
-    data = response.candidates[0].content.parts[0].inline_data.data
+        ),
+    )
+    return response.candidates[0].content.parts[0].inline_data.data
 
-    # decoded_data = base64.b64decode(data)
+def convert_wav_to_mp3(wav_path, mp3_path):
+    with trace_span("ffmpeg", operation="wav_to_mp3") as span:
+        result = subprocess.run(
+            ["ffmpeg", "-y", "-i", wav_path, mp3_path],
+            text=True,
+            capture_output=True
+        )
+        span["attrs"]["returncode"] = result.returncode
+    return result
 
-    response.usage_metadata
+def generate_audio_file_from_transcript_gemini_tts():
+    print("Generating audio file using Gemini TTS...")
+    print(f"st.session_state.default_audio_file_path_txt: {st.session_state.default_audio_file_path_txt}")
+    with open(st.session_state.default_audio_file_path_txt, "r") as f:
+        st.session_state.curated_transcript = f.read()
+    init_audio_prompts()
+    voice_name = get_gemini_tts_voice_name()
 
-    rate = 24000
-    file_name = f'test.wav'
+    with trace_span("tts", engine="gemini", voice=voice_name, text_chars=len(st.session_state.curated_transcript)) as span:
+        data = run_coroutine(agenerate_gemini_tts(st.session_state.gemini_api_key, st.session_state.gemini_tts_prompt, voice_name))
+        span["attrs"]["audio_bytes"] = len(data)
 
-    print(f"\nSaving sample rate: {rate}")
-    gemini_tts_wave_file(st.session_state.default_audio_file_path_wav, data, rate=rate)
+    print(f"\nSaving sample rate: {GEMINI_TTS_SAMPLE_RATE}")
+    gemini_tts_wave_file(st.session_state.default_audio_file_path_wav, data, rate=GEMINI_TTS_SAMPLE_RATE)
 
-    result = subprocess.run(
-        ["ffmpeg", "-y", "-i", st.session_state.default_audio_file_path_wav, st.session_state.default_audio_file_path_mp3],
-        input=st.session_state.curated_transcript,
-        text=True,
-        capture_output=True
-    )
+    result = convert_wav_to_mp3(st.session_state.default_audio_file_path_wav, st.session_state.default_audio_file_path_mp3)
     #print(f"Result of ffmpeg command: {result}")
     if result.returncode != 0:
         st.warning(f"Conversion to mp3 failed: \n {result.stderr}")
@@ -202,6 +197,36 @@ def generate_audio_file_from_transcript_gemini_tts():
 
     st.audio(st.session_state.default_audio_file_path_wav)
 
+def generate_audio_files_gemini_tts(jobs):
+    """
+    Synthesize many transcripts concurrently with Gemini TTS.
+    Each job is a dict with transcript, wav_path and mp3_path.
+    Returns the jobs that failed.
+    """
+    voice_name = get_gemini_tts_voice_name()
+    prompts = []
+    for job in jobs:
+        st.session_state.curated_transcript = job["transcript"]
+        init_audio_prompts()
+        prompts.append(st.session_state.gemini_tts_prompt)
+
+    with trace_span("tts", engine="gemini", voice=voice_name, files=len(jobs)) as span:
+        results = run_coroutines([agenerate_gemini_tts(st.session_state.gemini_api_key, prompt, voice_name) for prompt in prompts])
+        span["attrs"]["audio_bytes"] = sum(len(data) for data in results if not isinstance(data, Exception))
+
+    failed = []
+    for job, data in zip(jobs, results):
+        if isinstance(data, Exception):
+            print(f"Gemini TTS failed for {job['wav_path']}: {data}")
+            failed.append(job)
+            continue
+        gemini_tts_wave_file(job["wav_path"], data, rate=GEMINI_TTS_SAMPLE_RATE)
+        result = convert_wav_to_mp3(job["wav_path"], job["mp3_path"])
+        if result.returncode != 0:
+            print(f"Conversion to mp3 failed for {job['wav_path']}: {result.stderr}")
+            failed.append(job)
+    return failed
+
 
 
 def get_available_names(data_dir):
@@ -0,0 +1,96 @@
+import os
+import threading
+
+import tiktoken
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Retrieved chunks are packed into the prompt by real token count rather than a
+# characters-per-token guess. cl100k_base is close enough for the models we call.
+CONTEXT_TOKENIZER_ENCODING = os.getenv("CONTEXT_TOKENIZER_ENCODING", "cl100k_base")
+CHUNK_SEPARATOR = "\n\n"
+# Shorter matches between neighbouring chunks are coincidence, not splitter overlap.
+MIN_CHUNK_OVERLAP = 16
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+def get_encoding():
+    """The tiktoken encoding, or None if it can't be loaded (e.g. no network to fetch the BPE file)."""
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                _encoding = tiktoken.get_encoding(CONTEXT_TOKENIZER_ENCODING)
+            except Exception as e:
+                print(f"Could not load tokenizer {CONTEXT_TOKENIZER_ENCODING}, estimating tokens from characters: {e}")
+                _encoding = False
+        return _encoding or None
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    encoding = get_encoding()
+    if encoding is None:
+        return text[: max_tokens * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+def merge_overlap(first: str, second: str) -> str:
+    """Join two neighbouring chunks, dropping the text the splitter repeated at the start of the second."""
+    for size in range(min(len(first), len(second)), MIN_CHUNK_OVERLAP - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + CHUNK_SEPARATOR + second
+
+def get_chunk_position(doc):
+    """(source_id, chunk_index) of a chunk, or None for chunks ingested without a position."""
+    metadata = doc.metadata or {}
+    if "source_id" in metadata and "chunk_index" in metadata:
+        return metadata["source_id"], int(metadata["chunk_index"])
+    return None
+
+def join_chunks(docs: list) -> str:
+    """
+    Join chunks into one context string. Chunks of the same source are put in
+    document order and neighbours are merged, sources keep their relevance order.
+    """
+    groups = {}
+    for doc in docs:
+        position = get_chunk_position(doc)
+        key = position[0] if position else id(doc)
+        groups.setdefault(key, []).append((position[1] if position else 0, doc.page_content))
+    parts = []
+    for chunks in groups.values():
+        chunks.sort(key=lambda chunk: chunk[0])
+        text = chunks[0][1]
+        for (previous_index, _), (chunk_index, chunk_text) in zip(chunks, chunks[1:]):
+            if chunk_index == previous_index + 1:
+                text = merge_overlap(text, chunk_text)
+            else:
+                text += CHUNK_SEPARATOR + chunk_text
+        parts.append(text)
+    return CHUNK_SEPARATOR.join(parts)
+
+def pack_context(docs: list, max_tokens: int) -> tuple:
+    """
+    Fill max_tokens with whole chunks, taken in relevance order. A chunk that doesn't
+    fit is skipped, a smaller one further down may still fit.
+    Returns the context and the chunks it contains.
+    """
+    selected = []
+    context = ""
+    for doc in docs:
+        candidate = join_chunks(selected + [doc])
+        if count_tokens(candidate) <= max_tokens:
+            selected.append(doc)
+            context = candidate
+    if not selected and docs:
+        # Not even the best chunk fits, send as much of it as the budget allows.
+        selected = docs[:1]
+        context = truncate_to_tokens(docs[0].page_content, max_tokens)
+    return context, selected
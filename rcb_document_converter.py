@@ -0,0 +1,292 @@
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+from contextlib import contextmanager
+from html.parser import HTMLParser
+
+from dotenv import load_dotenv
+from docling.chunking import HybridChunker
+from docling.datamodel.accelerator_options import AcceleratorOptions
+from docling.datamodel.base_models import InputFormat
+from docling.datamodel.pipeline_options import PdfPipelineOptions, TableFormerMode
+from docling.datamodel.settings import settings
+from docling.document_converter import DocumentConverter, ImageFormatOption, PdfFormatOption
+from docling_core.types.doc import DoclingDocument
+from langchain_core.documents import Document
+from pypdf import PdfReader
+
+from rcb_trace import trace_span
+
+load_dotenv()
+
+# Converted documents are kept as DoclingDocument JSON, keyed by the sha256 of the
+# file content, so the same file is only ever laid out once (for any user).
+DOCLING_CACHE_DIR = os.getenv("DOCLING_CACHE_DIR", f"{os.getenv('DATA_DIR', '/tmp/rcb_data')}/docling_cache")
+
+# Pipeline options per document class. Born-digital PDFs carry their own text layer
+# and skip OCR, scans need OCR and the slower, more accurate table model.
+# Override with DOCLING_PROFILES='{"digital": {"table_mode": "accurate"}}'
+CONVERTER_PROFILES = {
+    "digital": {"do_ocr": False, "do_table_structure": True, "table_mode": "fast"},
+    "scanned": {"do_ocr": True, "do_table_structure": True, "table_mode": "accurate"},
+}
+for _profile, _options in json.loads(os.getenv("DOCLING_PROFILES", "{}")).items():
+    CONVERTER_PROFILES[_profile] = {**CONVERTER_PROFILES.get(_profile, CONVERTER_PROFILES["scanned"]), **_options}
+DOCLING_NUM_THREADS = int(os.getenv("DOCLING_NUM_THREADS", "4"))
+# Pages laid out per batch, bounds memory use on long documents.
+settings.perf.page_batch_size = int(os.getenv("DOCLING_PAGE_BATCH_SIZE", str(settings.perf.page_batch_size)))
+# Warm converters kept per profile, i.e. how many documents of one class convert at the same time.
+DOCLING_CONVERTERS_PER_PROFILE = int(os.getenv("DOCLING_CONVERTERS_PER_PROFILE", "1"))
+# A PDF page with an image and fewer extractable characters than this is treated as scanned.
+PDF_TEXT_MIN_CHARS_PER_PAGE = int(os.getenv("PDF_TEXT_MIN_CHARS_PER_PAGE", "200"))
+# Share of scanned pages a PDF may have and still be read from its text layer.
+# Any scanned page sends the document to docling by default, its text would be lost otherwise.
+PDF_MAX_SCANNED_PAGE_RATIO = float(os.getenv("PDF_MAX_SCANNED_PAGE_RATIO", "0"))
+# Share of letters, digits and whitespace below which a text layer is considered garbled.
+PDF_TEXT_MIN_CLEAN_RATIO = float(os.getenv("PDF_TEXT_MIN_CLEAN_RATIO", "0.85"))
+
+# Plain formats and born-digital PDFs are read directly instead of going through
+# docling layout analysis. Set INGEST_FAST_PATH=false to send everything to docling.
+INGEST_FAST_PATH = os.getenv("INGEST_FAST_PATH", "true").lower() == "true"
+INGEST_FAST_PATH_PDF = os.getenv("INGEST_FAST_PATH_PDF", "true").lower() == "true"
+TEXT_EXTENSIONS = (".md", ".markdown", ".txt")
+ASCIIDOC_EXTENSIONS = (".adoc", ".asciidoc")
+HTML_EXTENSIONS = (".html", ".htm")
+
+# Process-wide converter pool, one queue of warm converters per profile.
+_converter_pools = {}
+_converter_pools_lock = threading.Lock()
+_converter_warm_up_started = False
+
+def file_digest(file_path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def page_has_images(page) -> bool:
+    if "/Resources" not in page or "/XObject" not in page["/Resources"]:
+        return False
+    return any(xobject.get_object().get("/Subtype") == "/Image" for xobject in page["/Resources"]["/XObject"].values())
+
+def read_pdf_pages(file_path: str):
+    """Text layer of every page as (text, has_images), or None if the PDF can't be read."""
+    try:
+        return [(page.extract_text() or "", page_has_images(page)) for page in PdfReader(file_path).pages]
+    except Exception as e:
+        print(f"Could not read text layer of {file_path}: {e}")
+        return None
+
+def is_good_text_layer(pages: list) -> bool:
+    """
+    Enough text on the pages, no (or few enough) pages that are just a scanned image,
+    and mostly readable characters rather than broken font encodings.
+    pages holds (text, has_images) per page.
+    """
+    if not pages:
+        return False
+    text = "".join(page_text for page_text, _ in pages)
+    if len(text.strip()) / len(pages) < PDF_TEXT_MIN_CHARS_PER_PAGE:
+        return False
+    # Sparse pages without images are title or blank pages, with an image they are scans.
+    scanned = sum(1 for page_text, has_images in pages if has_images and len(page_text.strip()) < PDF_TEXT_MIN_CHARS_PER_PAGE)
+    if scanned / len(pages) > PDF_MAX_SCANNED_PAGE_RATIO:
+        return False
+    clean = sum(1 for c in text if c.isalnum() or c.isspace() or c in ".,;:!?()[]'\"-/%")
+    return clean / len(text) >= PDF_TEXT_MIN_CLEAN_RATIO
+
+def pdf_has_text_layer(file_path: str) -> bool:
+    """True if every page of the PDF has a usable text layer, i.e. it is born-digital."""
+    pages = read_pdf_pages(file_path)
+    return pages is not None and is_good_text_layer(pages)
+
+class HtmlToMarkdown(HTMLParser):
+    """
+    Minimal HTML to markdown: headings, paragraphs, list items, table rows and
+    definition lists, scripts and styles dropped. Table cells are joined with " | "
+    so neighbouring cells (e.g. a CLI flag and its description) stay separate words.
+    """
+
+    BLOCK_TAGS = {"p", "div", "br", "section", "article", "table", "ul", "ol", "dl", "pre", "blockquote"}
+    LINE_TAGS = {"tr", "li", "dt", "dd"}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skip = 0
+        self.row_cells = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style", "head"):
+            self.skip += 1
+        elif re.fullmatch(r"h[1-6]", tag):
+            self.parts.append("\n\n" + "#" * int(tag[1]) + " ")
+        elif tag == "li":
+            self._new_line()
+            self.parts.append("- ")
+        elif tag == "tr":
+            self.row_cells = 0
+            self._new_line()
+        elif tag in ("td", "th"):
+            if self.row_cells:
+                self.parts.append(" | ")
+            self.row_cells += 1
+        elif tag == "dt":
+            self._new_line()
+        elif tag == "dd":
+            self.parts.append(": ")
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append("\n\n")
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style", "head"):
+            self.skip = max(0, self.skip - 1)
+        elif re.fullmatch(r"h[1-6]", tag) or tag in self.BLOCK_TAGS:
+            self.parts.append("\n\n")
+        elif tag in self.LINE_TAGS:
+            self._new_line()
+
+    def _new_line(self):
+        if self.parts and not self.parts[-1].endswith("\n"):
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(data)
+
+    def markdown(self) -> str:
+        return re.sub(r"\n{3,}", "\n\n", "".join(self.parts)).strip()
+
+def asciidoc_to_markdown(text: str) -> str:
+    # Section titles ("== Title") become markdown headings so the header splitter sees them.
+    return re.sub(r"^(={1,6}) (?=\S)", lambda m: "#" * len(m.group(1)) + " ", text, flags=re.MULTILINE)
+
+def extract_text_fast(file_path: str):
+    """
+    Read file_path without docling when its format allows it.
+    Returns the content as markdown, or None if the file needs the full docling pipeline.
+    """
+    if not INGEST_FAST_PATH:
+        return None
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in TEXT_EXTENSIONS + ASCIIDOC_EXTENSIONS + HTML_EXTENSIONS:
+        with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+            text = f.read()
+        if extension in ASCIIDOC_EXTENSIONS:
+            return asciidoc_to_markdown(text)
+        if extension in HTML_EXTENSIONS:
+            parser = HtmlToMarkdown()
+            parser.feed(text)
+            return parser.markdown()
+        return text
+    if extension == ".pdf" and INGEST_FAST_PATH_PDF:
+        pages = read_pdf_pages(file_path)
+        # Scanned, partly scanned or garbled PDFs need docling OCR/layout.
+        if pages is None or not is_good_text_layer(pages):
+            return None
+        return "\n\n".join(text.strip() for text, _ in pages if text.strip())
+    return None
+
+def pdf_fast_path_enabled() -> bool:
+    return INGEST_FAST_PATH and INGEST_FAST_PATH_PDF
+
+def get_reachable_profiles() -> list:
+    """Profiles choose_converter_profile can return with the current settings."""
+    # With the PDF fast path on, born-digital PDFs never get to docling.
+    return ["scanned"] if pdf_fast_path_enabled() else ["digital", "scanned"]
+
+def choose_converter_profile(file_path: str) -> str:
+    """Pick the pipeline options profile for the document class of file_path."""
+    # A PDF that passed the text layer check was already read by extract_text_fast.
+    if not pdf_fast_path_enabled() and file_path.lower().endswith(".pdf") and pdf_has_text_layer(file_path):
+        return "digital"
+    # Scanned PDFs and images need OCR, office formats ignore the PDF options anyway.
+    return "scanned"
+
+def create_converter(profile: str) -> DocumentConverter:
+    options = CONVERTER_PROFILES[profile]
+    pipeline_options = PdfPipelineOptions()
+    pipeline_options.do_ocr = options["do_ocr"]
+    pipeline_options.do_table_structure = options["do_table_structure"]
+    pipeline_options.table_structure_options.mode = TableFormerMode(options["table_mode"])
+    pipeline_options.accelerator_options = AcceleratorOptions(num_threads=DOCLING_NUM_THREADS)
+    converter = DocumentConverter(
+        format_options={
+            InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options),
+            InputFormat.IMAGE: ImageFormatOption(pipeline_options=pipeline_options),
+        }
+    )
+    # Load the layout/table/OCR models now rather than on the first document.
+    converter.initialize_pipeline(InputFormat.PDF)
+    return converter
+
+def _get_converter_pool(profile: str) -> queue.Queue:
+    with _converter_pools_lock:
+        if profile not in _converter_pools:
+            print(f"Creating {DOCLING_CONVERTERS_PER_PROFILE} docling converter(s) for profile: {profile} {CONVERTER_PROFILES[profile]}")
+            pool = queue.Queue()
+            for _ in range(DOCLING_CONVERTERS_PER_PROFILE):
+                pool.put(create_converter(profile))
+            _converter_pools[profile] = pool
+        return _converter_pools[profile]
+
+@contextmanager
+def converter_for(profile: str):
+    """Borrow a warm converter for profile, waiting if all of them are busy."""
+    pool = _get_converter_pool(profile)
+    converter = pool.get()
+    try:
+        yield converter
+    finally:
+        pool.put(converter)
+
+def warm_up_converters():
+    """Create the converter pools of the reachable profiles in the background at startup, others are created on first use."""
+    global _converter_warm_up_started
+    with _converter_pools_lock:
+        if _converter_warm_up_started:
+            return
+        _converter_warm_up_started = True
+
+    def warm_up():
+        for profile in get_reachable_profiles():
+            _get_converter_pool(profile)
+
+    threading.Thread(target=warm_up, name="docling-warm-up", daemon=True).start()
+
+def convert_document(file_path: str) -> DoclingDocument:
+    """Convert file_path with docling, or load the cached result of an earlier conversion of the same content."""
+    digest = file_digest(file_path)
+    profile = choose_converter_profile(file_path)
+    # Options change the result, so the profile is part of the key.
+    cache_path = f"{DOCLING_CACHE_DIR}/{digest}.{profile}.json"
+    with trace_span("docling_convert", file=os.path.basename(file_path), bytes=os.path.getsize(file_path), profile=profile) as span:
+        if os.path.exists(cache_path):
+            span["attrs"]["cache_hit"] = True
+            print(f"DOCLING CACHE HIT: {file_path} ({digest})")
+            return DoclingDocument.load_from_json(cache_path)
+        span["attrs"]["cache_hit"] = False
+        with converter_for(profile) as converter:
+            document = converter.convert(file_path).document
+        span["attrs"]["pages"] = len(document.pages)
+    os.makedirs(DOCLING_CACHE_DIR, exist_ok=True)
+    # Write to a temporary name first so a crash never leaves a truncated entry behind.
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    document.save_as_json(tmp_path)
+    os.replace(tmp_path, cache_path)
+    return document
+
+def chunk_document(document: DoclingDocument, source: str) -> list:
+    """Split a converted document into LangChain Documents, the same way DoclingLoader does."""
+    chunker = HybridChunker()
+    return [
+        Document(
+            page_content=chunker.contextualize(chunk=chunk),
+            metadata={"source": source, "dl_meta": chunk.meta.export_json_dict()},
+        )
+        for chunk in chunker.chunk(document)
+    ]
@@ -5,6 +5,8 @@ import glob
 
 import streamlit as st
 
+from rcb_trace import trace_span
+
 from pathlib import Path
 
 def init_edit_video_page():
@@ -86,7 +88,8 @@ def concat_videos(directory):
             command = f"ffmpeg -y -f concat -safe 0 -i {st.session_state.user_temp_dir}/list.txt -c:v libx264 -preset fast -crf 18 -an {st.session_state.generate_video_file_path}  > /dev/null 2>&1"
         print("Executing command to concatenate:", command)
         # os.system(command)
-        subprocess.run(command, shell=True, check=True)
+        with trace_span("ffmpeg", operation="concat", videos=len(video_files_to_join)):
+            subprocess.run(command, shell=True, check=True)
 
 def get_remaining_video_segments(provided_segments, total_duration):
     """
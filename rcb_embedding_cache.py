@@ -0,0 +1,85 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+
+load_dotenv()
+
+# Chunk embeddings keyed by (model, sha256 of the chunk text), shared by all users.
+# Re-ingesting a revised document only embeds the chunks whose text changed.
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", f"{os.getenv('DATA_DIR', '/tmp/rcb_data')}/embedding_cache")
+
+_cache_lock = threading.Lock()
+
+def _connect():
+    os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(f"{EMBEDDING_CACHE_DIR}/embeddings.db", timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+    return conn
+
+def make_embedding_key(model_name: str, text: str) -> str:
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that only sends document texts without a cached vector to the model."""
+
+    def __init__(self, model: Embeddings, model_name: str):
+        self.model = model
+        self.model_name = model_name
+
+    def embed_documents(self, texts: list) -> list:
+        if not EMBEDDING_CACHE_ENABLED:
+            return self.model.embed_documents(texts)
+        keys = [make_embedding_key(self.model_name, text) for text in texts]
+        vectors = self._load(set(keys))
+        # Identical texts within the call are embedded once.
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+        print(f"EMBEDDING CACHE: {len(texts) - len(missing)} of {len(texts)} chunks cached")
+        if missing:
+            new_vectors = dict(zip(missing, self.model.embed_documents(list(missing.values()))))
+            self._store(new_vectors)
+            vectors.update(new_vectors)
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> list:
+        # Queries are rarely repeated word for word, the retrieval cache handles repeats.
+        return self.model.embed_query(text)
+
+    def _load(self, keys: set) -> dict:
+        vectors = {}
+        keys = list(keys)
+        with _cache_lock:
+            conn = _connect()
+            try:
+                # Stay below SQLite's limit on host parameters.
+                for start in range(0, len(keys), 500):
+                    batch = keys[start:start + 500]
+                    rows = conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                    ).fetchall()
+                    for key, blob in rows:
+                        vectors[key] = array("f", blob).tolist()
+            finally:
+                conn.close()
+        return vectors
+
+    def _store(self, vectors: dict):
+        with _cache_lock:
+            conn = _connect()
+            try:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, array("f", vector).tobytes()) for key, vector in vectors.items()],
+                )
+                conn.commit()
+            finally:
+                conn.close()
@@ -0,0 +1,91 @@
+import itertools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+
+load_dotenv()
+
+# Texts from all sessions are queued and embedded together in micro-batches,
+# a batch closes when it is full or when the oldest text waited long enough.
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "10"))
+
+# Retrieval queries are waited on by a user, they go ahead of document chunks.
+QUERY_PRIORITY = 0
+DOCUMENT_PRIORITY = 1
+
+class BatchingEmbeddings(Embeddings):
+    """
+    LangChain Embeddings backed by a single worker thread that owns the model.
+    Requests from every session are queued and run as micro-batches, so many small
+    concurrent calls become a few larger forward passes.
+    """
+
+    def __init__(self, model: Embeddings, batch_size: int = EMBEDDING_BATCH_SIZE, batch_wait_ms: float = EMBEDDING_BATCH_WAIT_MS):
+        self.model = model
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait_ms / 1000
+        self.queue = queue.PriorityQueue()
+        # Tie breaker keeps FIFO order within a priority and avoids comparing futures.
+        self.sequence = itertools.count()
+        self.stats = {"batches": 0, "texts": 0, "busy_seconds": 0.0}
+        self.stats_lock = threading.Lock()
+        self.worker = threading.Thread(target=self._run, name="embedding-service", daemon=True)
+        self.worker.start()
+
+    def _submit(self, texts: list, priority: int) -> list:
+        futures = []
+        for text in texts:
+            future = Future()
+            self.queue.put((priority, next(self.sequence), text, future))
+            futures.append(future)
+        return futures
+
+    def embed_documents(self, texts: list, priority: int = DOCUMENT_PRIORITY) -> list:
+        """Embed texts, pass priority=QUERY_PRIORITY for texts a user is waiting on (e.g. retrieved sentences)."""
+        return [future.result() for future in self._submit(texts, priority)]
+
+    def embed_query(self, text: str) -> list:
+        return self._submit([text], QUERY_PRIORITY)[0].result()
+
+    def _next_batch(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            started = time.perf_counter()
+            try:
+                vectors = self.model.embed_documents([item[2] for item in batch])
+            except Exception as e:
+                print(f"Embedding batch of {len(batch)} failed: {e}")
+                for item in batch:
+                    item[3].set_exception(e)
+                continue
+            for item, vector in zip(batch, vectors):
+                item[3].set_result(vector)
+            with self.stats_lock:
+                self.stats["batches"] += 1
+                self.stats["texts"] += len(batch)
+                self.stats["busy_seconds"] += time.perf_counter() - started
+
+    def get_stats(self) -> dict:
+        """Batches run so far, texts embedded, mean batch size and pending texts."""
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats["mean_batch_size"] = stats["texts"] / stats["batches"] if stats["batches"] else 0.0
+        stats["pending"] = self.queue.qsize()
+        return stats
@@ -8,6 +8,7 @@ from pathlib import Path
 from git import Repo
 
 from rcb_init import init_github_vars, add_log
+from rcb_trace import trace_span
 
 def create_github_repo(repo_name) -> bool:
     """
@@ -156,13 +157,14 @@ def push_to_github():
         return
 
     try:
-        repo = Repo(repo_path)
-        repo.git.add(A=True)  # Add all changes
-        st.session_state.commit_message = f"{st.session_state.commit_message} \nContent generated using {st.session_state.model_choice} via RCB."
-        repo.index.commit(st.session_state.commit_message)  # Commit changes
-        origin = repo.remote(name='origin')
-        origin.pull()  # Pull latest changes from remote to avoid conflicts
-        origin.push()  # Push changes to remote
+        with trace_span("git_push", repo=st.session_state.repo_name):
+            repo = Repo(repo_path)
+            repo.git.add(A=True)  # Add all changes
+            st.session_state.commit_message = f"{st.session_state.commit_message} \nContent generated using {st.session_state.model_choice} via RCB."
+            repo.index.commit(st.session_state.commit_message)  # Commit changes
+            origin = repo.remote(name='origin')
+            origin.pull()  # Pull latest changes from remote to avoid conflicts
+            origin.push()  # Push changes to remote
         time.sleep(5)  # Wait for a few seconds to ensure push is complete
         st.session_state.progress_logs.success(f"Changes pushed to GitHub repository '{st.session_state.repo_name}' successfully.")
         print(f"Changes pushed to GitHub repository '{st.session_state.repo_name}' successfully.")
@@ -10,11 +10,13 @@ from langchain_openai import ChatOpenAI
 # from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 import google.genai as genai
 
+from rcb_trace import show_trace_waterfall
+
 def add_log(message: str):
     """Add a message to the logs"""
     timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
     st.session_state.logs.append(f"[{timestamp}] {message}")
-    print(f"LOG: {st.session_state.logs}")
+    print(f"LOG: [{timestamp}] {message}")
 
 def display_top_banner():
     load_dotenv()
@@ -73,6 +75,7 @@ def init_page():
         os.makedirs(f"{st.session_state.user_dir}/video", exist_ok=True)
         os.makedirs(f"{st.session_state.user_dir}/saved_videos", exist_ok=True)
         os.makedirs(f"{st.session_state.user_dir}/images", exist_ok=True)
+        show_trace_waterfall()
     else:
         if st.session_state.current_page != "Home":
             st.sidebar.warning("Not logged in. [Go to Login Page](./)")
@@ -145,9 +148,15 @@ def init_llm_vars():
     if 'system_prompt' not in st.session_state:
         st.session_state.system_prompt = ""
 
+    # "Auto" lets rcb_llm_router pick a model per task from observed latency and cost
+    model_options = ["MaaS", "Gemini", "Auto"]
+    # Offline model served from our own hardware, see rcb_llm_manager.LOCAL_LLM_API_BASE
+    if os.environ.get("LOCAL_LLM_API_BASE"):
+        model_options.append("Local")
+
     st.session_state.model_choice = st.sidebar.selectbox(
         "Choose LLM Model",
-        options=["MaaS", "Gemini"],
+        options=model_options,
         index=0,
         disabled=st.session_state.disable_all
     )
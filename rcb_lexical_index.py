@@ -0,0 +1,116 @@
+import os
+import re
+import sqlite3
+
+# BM25 keyword index next to the user's vector store, kept in SQLite FTS5:
+#   {user_dir}/rag_db/lexical.db
+# Product names, CLI flags and error codes match exactly here, where dense
+# embeddings often miss them. "-", "_" and "." are part of a token so that
+# "--all-namespaces", "max_tokens" or "4.12" stay whole.
+TOKEN_PATTERN = re.compile(r"[\w\-.]+")
+
+def get_index_path(user_dir: str) -> str:
+    return f"{user_dir}/rag_db/lexical.db"
+
+def index_exists(user_dir: str) -> bool:
+    return os.path.exists(get_index_path(user_dir))
+
+def _connect(user_dir: str):
+    os.makedirs(os.path.dirname(get_index_path(user_dir)), exist_ok=True)
+    conn = sqlite3.connect(get_index_path(user_dir), timeout=30)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(chunks)")]
+    if columns and "source" not in columns:
+        # Index from before the source path was stored, rebuild it from the vectorstore.
+        conn.execute("DROP TABLE chunks")
+        conn.execute("DROP TABLE IF EXISTS meta")
+    conn.execute(
+        """CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(
+            chunk_id UNINDEXED,
+            source_id UNINDEXED,
+            source UNINDEXED,
+            text UNINDEXED,
+            terms,
+            tokenize = "unicode61 tokenchars '-_.'"
+        )"""
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+def _terms(text: str) -> str:
+    # Sentence punctuation would otherwise end up inside tokens ("error." vs "error").
+    return " ".join(token.strip(".") for token in TOKEN_PATTERN.findall(text) if token.strip(".-"))
+
+def is_backfilled(user_dir: str) -> bool:
+    """True once every chunk of the vectorstore has been indexed (see mark_backfilled)."""
+    if not index_exists(user_dir):
+        return False
+    conn = _connect(user_dir)
+    try:
+        return conn.execute("SELECT 1 FROM meta WHERE key = 'backfilled'").fetchone() is not None
+    finally:
+        conn.close()
+
+def mark_backfilled(user_dir: str):
+    conn = _connect(user_dir)
+    try:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('backfilled', '1')")
+        conn.commit()
+    finally:
+        conn.close()
+
+def upsert_chunks(user_dir: str, chunks: list):
+    """Index chunks given as (chunk_id, source_id, source, text), replacing earlier versions of the same ids."""
+    if not chunks:
+        return
+    conn = _connect(user_dir)
+    try:
+        ids = [chunk[0] for chunk in chunks]
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            conn.execute(f"DELETE FROM chunks WHERE chunk_id IN ({','.join('?' * len(batch))})", batch)
+        conn.executemany(
+            "INSERT INTO chunks (chunk_id, source_id, source, text, terms) VALUES (?, ?, ?, ?, ?)",
+            [(chunk_id, source_id, source, text, _terms(text)) for chunk_id, source_id, source, text in chunks],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def delete_chunks(user_dir: str, chunk_ids: list):
+    if not chunk_ids or not index_exists(user_dir):
+        return
+    conn = _connect(user_dir)
+    try:
+        for start in range(0, len(chunk_ids), 500):
+            batch = chunk_ids[start:start + 500]
+            conn.execute(f"DELETE FROM chunks WHERE chunk_id IN ({','.join('?' * len(batch))})", batch)
+        conn.commit()
+    finally:
+        conn.close()
+
+def delete_source(user_dir: str, source_id: str, source: str):
+    """Remove a document's chunks, matched like the vectorstore does: by source_id or, for older chunks, by file path."""
+    if not index_exists(user_dir):
+        return
+    conn = _connect(user_dir)
+    try:
+        conn.execute("DELETE FROM chunks WHERE source_id = ? OR source = ?", (source_id, source))
+        conn.commit()
+    finally:
+        conn.close()
+
+def search(user_dir: str, query: str, k: int) -> list:
+    """Best k chunks for query by BM25, as (chunk_id, source_id, text), best first."""
+    terms = _terms(query).split()
+    if not terms or not index_exists(user_dir):
+        return []
+    # Any term may match, BM25 ranks chunks that match more and rarer terms higher.
+    match = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+    conn = _connect(user_dir)
+    try:
+        return conn.execute(
+            "SELECT chunk_id, source_id, text FROM chunks WHERE chunks MATCH ? ORDER BY bm25(chunks) LIMIT ?",
+            (f"terms : ({match})", k),
+        ).fetchall()
+    finally:
+        conn.close()
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Content-addressed, disk-backed cache for LLM responses.
+# The key covers provider, model, prompts and sampling parameters, so any
+# change to one of them is a different entry.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", f"{os.getenv('DATA_DIR', '/tmp/rcb_data')}/llm_cache")
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# 0 disables expiry
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", "0"))
+
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+def _connect():
+    os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(f"{LLM_CACHE_DIR}/llm_cache.db", timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+    return conn
+
+def make_cache_key(provider: str, model_name: str, system_prompt: str, user_prompt: str, params: dict) -> str:
+    payload = json.dumps(
+        {
+            "provider": provider,
+            "model": model_name,
+            "system_prompt": system_prompt,
+            "user_prompt": user_prompt,
+            "params": params,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get_cached_response(key: str):
+    """Return the cached response for key, or None on a miss."""
+    if not LLM_CACHE_ENABLED:
+        return None
+    now = time.time()
+    with _cache_lock:
+        conn = _connect()
+        try:
+            row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and LLM_CACHE_TTL_SECONDS and now - row[1] > LLM_CACHE_TTL_SECONDS:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                conn.commit()
+                _cache_stats["expired"] += 1
+                row = None
+            if row is None:
+                _cache_stats["misses"] += 1
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            conn.commit()
+            _cache_stats["hits"] += 1
+            return row[0]
+        finally:
+            conn.close()
+
+def store_cached_response(key: str, response: str):
+    if not LLM_CACHE_ENABLED or not response:
+        return
+    now = time.time()
+    size = len(response.encode("utf-8"))
+    with _cache_lock:
+        conn = _connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now),
+            )
+            _cache_stats["stores"] += 1
+            # Evict least recently used entries until we are back under the size limit.
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            while total > LLM_CACHE_MAX_BYTES:
+                oldest = conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC LIMIT 1").fetchone()
+                if oldest is None:
+                    break
+                conn.execute("DELETE FROM responses WHERE key = ?", (oldest[0],))
+                total -= oldest[1]
+                _cache_stats["evictions"] += 1
+            conn.commit()
+        finally:
+            conn.close()
+
+def get_cache_stats() -> dict:
+    """Hit/miss counters for this process plus the current size of the cache on disk."""
+    with _cache_lock:
+        stats = dict(_cache_stats)
+        conn = _connect()
+        try:
+            entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        finally:
+            conn.close()
+    lookups = stats["hits"] + stats["misses"]
+    stats["entries"] = entries
+    stats["bytes"] = total
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
@@ -1,6 +1,7 @@
 import streamlit as st
 from langchain_openai import ChatOpenAI
 import google.genai as genai
+from google.genai import types
 # from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from langchain_core.callbacks import StreamingStdOutCallbackHandler
 from langchain_core.prompts import ChatPromptTemplate
@@ -8,12 +9,222 @@ from langchain_core.output_parsers import StrOutputParser
 
 from dotenv import load_dotenv
 import os
+import json
+import asyncio
+import threading
+import httpx
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from rcb_llm_cache import make_cache_key, get_cached_response, store_cached_response, get_cache_stats
+from rcb_llm_scheduler import run_with_retry, provider_slot, record_token_usage, estimate_tokens, is_retryable_error, get_retry_delay, LLM_MAX_RETRIES
+from rcb_llm_scheduler import is_provider_available, is_provider_failure, get_error_status, record_call_result, release_trial, run_with_retry_async
+import time
+
+from rcb_trace import trace_span, copy_trace_context
+from rcb_llm_router import route_model_choice, record_observation, record_failure, get_latency_stats
 
 MAAS_API_KEY = os.environ["MAAS_API_KEY"]
 MAAS_API_BASE = os.environ["MAAS_API_BASE"]
 MAAS_MODEL_NAME = os.environ["MAAS_MODEL_NAME"]
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE")
+GEMINI_MODEL_NAME = "gemini-2.5-flash"
+
+# Local model served by an OpenAI-compatible server running on our own hardware,
+# e.g. llama.cpp: llama-server -m model.gguf --port 8080 --parallel 4 --cont-batching
+# The server keeps the model resident and batches concurrent requests (see call_llm_batch).
+LOCAL_LLM_API_BASE = os.environ.get("LOCAL_LLM_API_BASE")
+LOCAL_LLM_MODEL_NAME = os.environ.get("LOCAL_LLM_MODEL_NAME", "local-model")
+LOCAL_LLM_API_KEY = os.environ.get("LOCAL_LLM_API_KEY", "not-needed")
+
+# Sampling parameters shared by all providers. Low temperature keeps the
+# responses close to deterministic, which is what makes them cacheable.
+LLM_TEMPERATURE = 0.05
+LLM_TOP_P = 0.9
+LLM_MAX_TOKENS = 8192
+
+# Output token budget and stop sequences per task (see rcb_llm_router.TASK_CLASSES),
+# so that short outputs don't reserve, and can't run on for, a full page worth of tokens.
+# D2 code comes back as a fenced block, a block cut off by the budget gets its closing fence back.
+# Override with LLM_TASK_BUDGETS='{"page_summary": {"max_tokens": 768}}'
+TASK_BUDGETS = {
+    "outline": {"max_tokens": 2048},
+    "page_summary": {"max_tokens": 1024},
+    "detailed_content": {"max_tokens": LLM_MAX_TOKENS},
+    "transcript_curation": {"max_tokens": 4096},
+    "d2_code": {"max_tokens": 2048, "close_fence": True},
+    "chat": {"max_tokens": 4096},
+}
+for _task, _budget in json.loads(os.getenv("LLM_TASK_BUDGETS", "{}")).items():
+    TASK_BUDGETS[_task] = {**TASK_BUDGETS.get(_task, {}), **_budget}
+
+# Gemini 2.5 counts thinking tokens against max_output_tokens. Thinking gets its own
+# budget, added on top, so the task budget is left for the answer. Off by default
+# (flash and flash-lite accept 0), models that can't turn it off need at least 128.
+GEMINI_THINKING_BUDGET = int(os.getenv("GEMINI_THINKING_BUDGET", "0"))
+
+# Keep-alive pool shared by every request made through one client.
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "120"))
+# Default number of prompts call_llm_batch runs at the same time.
+LLM_BATCH_MAX_CONCURRENCY = int(os.getenv("LLM_BATCH_MAX_CONCURRENCY", "4"))
+
+# Failover between MaaS and Gemini when one of them errors or its circuit is open.
+LLM_FAILOVER_ENABLED = os.getenv("LLM_FAILOVER_ENABLED", "true").lower() == "true"
+# Hedging: when a call runs longer than the model's p95 for the task, send the same
+# request to the other provider and keep whichever answer comes first.
+LLM_HEDGING_ENABLED = os.getenv("LLM_HEDGING_ENABLED", "true").lower() == "true"
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "5"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "2"))
+LLM_HEDGE_MAX_WORKERS = int(os.getenv("LLM_HEDGE_MAX_WORKERS", "16"))
+
+# Prompt template is immutable, build it once for the whole process.
+MAAS_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        ("system", "{system_prompt}"),
+        ("human", "{user_prompt}"),
+    ]
+)
+
+# Process-wide client registry, shared by all Streamlit sessions.
+_llm_clients = {}
+_llm_clients_lock = threading.Lock()
+
+# Identical requests currently being generated, keyed by response cache key.
+# Only the first caller (the leader) talks to the provider, the others wait for its result.
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+# Output tokens used per task, compared against the budget in get_budget_report.
+_budget_usage = {}
+_budget_usage_lock = threading.Lock()
+
+# Event loop for the async Gemini path, shared by all sessions. Every coroutine runs on
+# this one loop, so the async client and its connection pool never cross event loops.
+_async_loop = None
+_async_loop_lock = threading.Lock()
+
+# Runs hedged attempts, shared by all sessions. A losing attempt finishes in the
+# background so its latency still feeds the stats.
+_hedge_executor = ThreadPoolExecutor(max_workers=LLM_HEDGE_MAX_WORKERS, thread_name_prefix="llm-hedge")
+
+def _begin_flight(key: str):
+    """Return (call, is_leader) for key, registering a new call if none is running."""
+    with _in_flight_lock:
+        call = _in_flight.get(key)
+        if call is not None:
+            call["waiters"] += 1
+            return call, False
+        call = {"event": threading.Event(), "result": None, "error": None, "waiters": 0}
+        _in_flight[key] = call
+        return call, True
+
+def _finish_flight(key: str, call: dict, result=None, error=None):
+    with _in_flight_lock:
+        _in_flight.pop(key, None)
+    call["result"] = result
+    call["error"] = error
+    if call["waiters"]:
+        print(f"LLM SINGLE-FLIGHT: shared result with {call['waiters']} waiting request(s)")
+    call["event"].set()
+
+def _wait_flight(call: dict):
+    """Wait for the leader. Returns its response, raises its error, or None if it gave up."""
+    print("LLM SINGLE-FLIGHT: waiting for identical request already in flight")
+    call["event"].wait()
+    if call["error"] is not None:
+        raise call["error"]
+    return call["result"]
+
+def _http_limits():
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+
+def get_maas_llm(api_key: str = MAAS_API_KEY, api_base: str = MAAS_API_BASE, model_name: str = MAAS_MODEL_NAME):
+    """Return the cached ChatOpenAI client for the given OpenAI-compatible endpoint/model/key."""
+    key = ("OpenAI", api_base, model_name, api_key)
+    with _llm_clients_lock:
+        if key not in _llm_clients:
+            print(f"Creating OpenAI-compatible client for model: {model_name} at {api_base}")
+            _llm_clients[key] = ChatOpenAI(
+                openai_api_key=api_key,
+                openai_api_base=api_base,
+                model_name=model_name,
+                temperature=LLM_TEMPERATURE,
+                max_tokens=LLM_MAX_TOKENS,
+                streaming=True,
+                #callbacks=[StreamingStdOutCallbackHandler()],
+                top_p=LLM_TOP_P,
+                #presence_penalty=0.5,
+                model_kwargs={
+                    "stream_options": {"include_usage": True}
+                },
+                http_client=httpx.Client(limits=_http_limits()),
+                http_async_client=httpx.AsyncClient(limits=_http_limits()))
+        return _llm_clients[key]
+
+def get_maas_chain(api_key: str = MAAS_API_KEY, api_base: str = MAAS_API_BASE, model_name: str = MAAS_MODEL_NAME,
+                   max_tokens: int = LLM_MAX_TOKENS, stop: list = None):
+    """Return the cached prompt | llm chain for the given endpoint/model/key and output budget."""
+    key = ("OpenAI-chain", api_base, model_name, api_key, max_tokens, tuple(stop or ()))
+    llm = get_maas_llm(api_key, api_base, model_name)
+    with _llm_clients_lock:
+        if key not in _llm_clients:
+            # The shared client is bound per budget, it still uses the same connection pool.
+            if max_tokens != LLM_MAX_TOKENS or stop:
+                llm = llm.bind(max_tokens=max_tokens, **({"stop": stop} if stop else {}))
+            _llm_clients[key] = MAAS_PROMPT | llm
+        return _llm_clients[key]
+
+def get_chain(model_choice: str, task: str = None):
+    """Return the chain for OpenAI-compatible providers (MaaS and Local)."""
+    params = get_sampling_params(task)
+    if get_provider(model_choice) == "Local":
+        if not LOCAL_LLM_API_BASE:
+            raise RuntimeError("Local model is not configured. Set LOCAL_LLM_API_BASE to an OpenAI-compatible server.")
+        return get_maas_chain(LOCAL_LLM_API_KEY, LOCAL_LLM_API_BASE, get_model_name(model_choice), params["max_tokens"], params.get("stop"))
+    return get_maas_chain(model_name=get_model_name(model_choice), max_tokens=params["max_tokens"], stop=params.get("stop"))
+
+def get_gemini_client(api_key: str):
+    """Return the cached google-genai client for the given key."""
+    key = ("Gemini", api_key)
+    with _llm_clients_lock:
+        if key not in _llm_clients:
+            print("Creating Gemini client")
+            _llm_clients[key] = genai.Client(api_key=api_key)
+        return _llm_clients[key]
+
+def get_async_loop():
+    """Return the process-wide event loop, started on a daemon thread on first use."""
+    global _async_loop
+    with _async_loop_lock:
+        if _async_loop is None:
+            _async_loop = asyncio.new_event_loop()
+            threading.Thread(target=_async_loop.run_forever, name="llm-async-loop", daemon=True).start()
+        return _async_loop
+
+def run_coroutine(coro):
+    """Run coro on the shared event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_async_loop()).result()
+
+def run_coroutines(coros: list) -> list:
+    """Run coros concurrently on the shared event loop. Returns results in order, the exception in place of a failed one."""
+    async def gather():
+        return await asyncio.gather(*coros, return_exceptions=True)
+    return run_coroutine(gather())
+
+async def agenerate_gemini_content(api_key: str, model: str, contents, config):
+    """Async generate_content over the cached client, under the Gemini rate limits and retries."""
+    client = get_gemini_client(api_key)
+    return await run_with_retry_async(
+        "Gemini",
+        estimate_tokens(contents if isinstance(contents, str) else ""),
+        lambda: client.aio.models.generate_content(model=model, contents=contents, config=config),
+    )
 
 # def build_prompt(system_prompt: str, user_prompt:str):
 #     #print(f"Building prompt with system prompt: {system_prompt} and image prompt: {user_prompt}")
@@ -25,66 +236,538 @@ GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE")
 #         ]
 #     )
 
-def call_llm_to_generate_response(model_choice: str, system_prompt: str, user_prompt: str):
-    if not st.session_state.use_default_prompts:
+# A model choice is either a provider ("MaaS", "Gemini", "Local"), which uses the
+# provider's default model, or "provider:model_name" to pick a specific model.
+def get_provider(model_choice: str) -> str:
+    return model_choice.partition(":")[0]
+
+def get_model_name(model_choice: str) -> str:
+    provider, _, model_name = model_choice.partition(":")
+    if model_name:
+        return model_name
+    if provider == "MaaS":
+        return MAAS_MODEL_NAME
+    elif provider == "Gemini":
+        return GEMINI_MODEL_NAME
+    elif provider == "Local":
+        return LOCAL_LLM_MODEL_NAME
+    return model_choice
+
+def get_sampling_params(task: str = None) -> dict:
+    budget = TASK_BUDGETS.get(task, {})
+    params = {"temperature": LLM_TEMPERATURE, "top_p": LLM_TOP_P, "max_tokens": budget.get("max_tokens", LLM_MAX_TOKENS)}
+    if budget.get("stop"):
+        params["stop"] = list(budget["stop"])
+    return params
+
+def get_gemini_config(task: str = None):
+    params = get_sampling_params(task)
+    return types.GenerateContentConfig(
+        temperature=params["temperature"],
+        top_p=params["top_p"],
+        max_output_tokens=params["max_tokens"] + GEMINI_THINKING_BUDGET,
+        thinking_config=types.ThinkingConfig(thinking_budget=GEMINI_THINKING_BUDGET),
+        stop_sequences=params.get("stop"),
+    )
+
+def get_gemini_usage(usage_metadata) -> dict:
+    """Token counts of a Gemini response, thinking tokens included in the output tokens they are billed as."""
+    thinking_tokens = usage_metadata.thoughts_token_count or 0
+    return {
+        "input_tokens": usage_metadata.prompt_token_count,
+        "output_tokens": (usage_metadata.candidates_token_count or 0) + thinking_tokens,
+        "thinking_tokens": thinking_tokens,
+    }
+
+def get_code_block_end(text: str, task: str = None):
+    """For tasks that return one code block, the position just past its closing fence, None while the block is open."""
+    if not TASK_BUDGETS.get(task, {}).get("close_fence"):
+        return None
+    start = text.find("```")
+    end = text.find("```", start + 3) if start != -1 else -1
+    return end + 3 if end != -1 else None
+
+def get_closing_fence(text: str, task: str = None) -> str:
+    """A code block cut off by the output budget is left open, return the fence that closes it."""
+    if TASK_BUDGETS.get(task, {}).get("close_fence") and text.count("```") % 2 == 1:
+        return "\n```"
+    return ""
+
+def finish_code_block(text: str, task: str = None) -> str:
+    """Drop what follows the code block of a complete response, or close the block the budget cut off."""
+    end = get_code_block_end(text, task)
+    if end is not None:
+        return text[:end]
+    return text + get_closing_fence(text, task)
+
+def record_budget_usage(task: str, usage: dict):
+    """Compare the output tokens of a call that reached the provider with the task's budget."""
+    output_tokens = usage.get("output_tokens")
+    if usage.get("cached") or usage.get("coalesced") or not output_tokens:
+        return
+    max_tokens = get_sampling_params(task)["max_tokens"]
+    if usage.get("thinking_tokens") is not None:
+        # Gemini output includes thinking, compare with the limit it was actually given.
+        max_tokens += GEMINI_THINKING_BUDGET
+    with _budget_usage_lock:
+        stats = _budget_usage.setdefault(task, {"calls": 0, "output_tokens": 0, "max_output_tokens": 0, "hit_budget": 0})
+        stats["calls"] += 1
+        stats["output_tokens"] += output_tokens
+        stats["max_output_tokens"] = max(stats["max_output_tokens"], output_tokens)
+        if output_tokens >= max_tokens:
+            stats["hit_budget"] += 1
+    print(f"LLM BUDGET: {task} used {output_tokens}/{max_tokens} output tokens")
+    if output_tokens >= max_tokens:
+        print(f"LLM BUDGET: {task} reached its output budget, the response is probably cut short")
+
+def get_budget_report() -> dict:
+    """Per task: output budget, calls, mean and max output tokens and how often the budget was reached."""
+    with _budget_usage_lock:
+        usage = {task: dict(stats) for task, stats in _budget_usage.items()}
+    report = {}
+    for task, stats in usage.items():
+        report[task] = {
+            "max_tokens": get_sampling_params(task)["max_tokens"],
+            "calls": stats["calls"],
+            "mean_output_tokens": stats["output_tokens"] / stats["calls"],
+            "max_output_tokens": stats["max_output_tokens"],
+            "hit_budget": stats["hit_budget"],
+        }
+    return report
+
+def call_llm_to_generate_response(model_choice: str, system_prompt: str, user_prompt: str, task: str = None):
+    """
+    Generate a response for the prompts. task names the kind of output (see rcb_llm_router.TASK_CLASSES),
+    it is used to pick a model when model_choice is "Auto".
+    """
+    if st.session_state.get("use_default_prompts") is False:
         print("Using custom prompts")
-        print("====================")
-    print(f"\nGenerating response with... \nmodel_choice: {model_choice} \nsystem_prompt: {system_prompt} \nuser_prompt: {user_prompt}")
-    if model_choice == "MaaS":
-        print("USING MODEL AS A SERVICE")
-        llm = ChatOpenAI(
-            openai_api_key=MAAS_API_KEY,
-            openai_api_base=MAAS_API_BASE,
-            model_name=MAAS_MODEL_NAME,
-            temperature=0.05,
-            max_tokens=8192,
-            streaming=True,
-            #callbacks=[StreamingStdOutCallbackHandler()],
-            top_p=0.9,
-            #presence_penalty=0.5,
-            model_kwargs={
-                "stream_options": {"include_usage": True}
-            })
-        parser = StrOutputParser()
-        # Prompt Template
-        prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", "{system_prompt}"),
-                ("human", "{user_prompt}"),
-            ]
+    model_choice = route_model_choice(model_choice, task, estimate_tokens(system_prompt, user_prompt))
+    with trace_span(
+        "llm_call",
+        task=task,
+        provider=get_provider(model_choice),
+        model=get_model_name(model_choice),
+        prompt_chars=len(system_prompt) + len(user_prompt),
+    ) as span:
+        usage = {}
+        response = _call_llm(model_choice, system_prompt, user_prompt, usage, task)
+        record_budget_usage(task, usage)
+        span["attrs"].update(usage)
+        span["attrs"]["max_tokens"] = get_sampling_params(task)["max_tokens"]
+        span["attrs"]["response_chars"] = len(response)
+        return response
+
+def _call_llm(model_choice: str, system_prompt: str, user_prompt: str, usage: dict, task: str = None):
+    cache_key = make_cache_key(model_choice, get_model_name(model_choice), system_prompt, user_prompt, get_sampling_params(task))
+    response = get_cached_response(cache_key)
+    if response is not None:
+        print(f"LLM CACHE HIT: {cache_key}")
+        usage["cached"] = True
+        return response
+    print(f"LLM CACHE MISS: {cache_key}")
+
+    call, is_leader = _begin_flight(cache_key)
+    if not is_leader:
+        response = _wait_flight(call)
+        if response is not None:
+            usage["coalesced"] = True
+            return response
+        return _call_llm(model_choice, system_prompt, user_prompt, usage, task)
+
+    try:
+        usage["cached"] = False
+        response, used_model_choice = generate_with_failover(model_choice, system_prompt, user_prompt, usage, task)
+        usage["used_model_choice"] = used_model_choice
+        # Only cache under the model that actually answered, waiters get the response from the flight.
+        store_cached_response(
+            make_cache_key(used_model_choice, get_model_name(used_model_choice), system_prompt, user_prompt, get_sampling_params(task)),
+            response,
+        )
+    except Exception as e:
+        _finish_flight(cache_key, call, error=e)
+        raise
+    _finish_flight(cache_key, call, result=response)
+    return response
+
+def get_alternate_model_choice(model_choice: str):
+    """The other hosted provider to fail over or hedge to, or None if there is none."""
+    if not LLM_FAILOVER_ENABLED:
+        return None
+    provider = get_provider(model_choice)
+    if provider == "MaaS" and st.session_state.get("gemini_api_key"):
+        return "Gemini"
+    if provider == "Gemini":
+        return "MaaS"
+    return None
+
+def get_hedge_delay(model_choice: str, task: str):
+    """Seconds to wait before hedging, the observed p95 for task, or None if hedging is off."""
+    if not LLM_HEDGING_ENABLED:
+        return None
+    stats = get_latency_stats(model_choice, task)
+    if stats is None or stats["count"] < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    return max(stats["p95"], LLM_HEDGE_MIN_DELAY)
+
+def _attempt(model_choice: str, system_prompt: str, user_prompt: str, usage: dict, task: str = None):
+    """One provider call with rate limits and retries, feeding latency stats and the circuit breaker."""
+    provider = get_provider(model_choice)
+    latencies = []
+
+    def timed_generate():
+        started = time.perf_counter()
+        response = generate_response(model_choice, system_prompt, user_prompt, usage, task)
+        latencies.append(time.perf_counter() - started)
+        return response
+
+    # One circuit breaker result per call, not per retry.
+    recorded = False
+    try:
+        response = run_with_retry(provider, estimate_tokens(system_prompt, user_prompt), timed_generate)
+        record_call_result(provider, True, latencies[-1])
+        recorded = True
+    except Exception as e:
+        if is_provider_failure(e):
+            record_call_result(provider, False)
+            recorded = True
+        # Lets the router move past a broken candidate (bad key, unknown model), throttling aside.
+        if get_error_status(e) != 429:
+            record_failure(model_choice)
+        raise
+    finally:
+        # A half-open circuit only lets one trial through, never leave it taken.
+        if not recorded:
+            release_trial(provider)
+    record_observation(model_choice, task, latencies[-1], usage)
+    record_token_usage(provider, usage.get("output_tokens"))
+    return response
+
+def generate_with_failover(model_choice: str, system_prompt: str, user_prompt: str, usage: dict, task: str = None):
+    """
+    Call model_choice, hedging with the alternate provider when the call runs past its p95
+    and failing over to it when the call fails or the provider's circuit is open.
+    Returns (response, model_choice that produced it).
+    """
+    alternate = get_alternate_model_choice(model_choice)
+    if alternate and not is_provider_available(get_provider(model_choice)):
+        print(f"LLM FAILOVER: {get_provider(model_choice)} circuit is open, using {alternate}")
+        usage["failover"] = True
+        return _attempt(alternate, system_prompt, user_prompt, usage, task), alternate
+
+    hedge_delay = get_hedge_delay(model_choice, task) if alternate else None
+    if hedge_delay is None:
+        try:
+            return _attempt(model_choice, system_prompt, user_prompt, usage, task), model_choice
+        except Exception as e:
+            if not alternate or not is_retryable_error(e) or not is_provider_available(get_provider(alternate)):
+                raise
+            print(f"LLM FAILOVER: {model_choice} failed ({e}), using {alternate}")
+            usage["failover"] = True
+            return _attempt(alternate, system_prompt, user_prompt, usage, task), alternate
+
+    # Hedged call, each attempt gets its own usage dict and runs in a worker.
+    ctx = get_script_run_ctx()
+    attempts = {}
+
+    def submit(attempt_model_choice):
+        attempt_usage = {}
+        trace_ctx = copy_trace_context()
+
+        def run():
+            add_script_run_ctx(threading.current_thread(), ctx)
+            return trace_ctx.run(_attempt, attempt_model_choice, system_prompt, user_prompt, attempt_usage, task)
+
+        attempts[_hedge_executor.submit(run)] = (attempt_model_choice, attempt_usage)
+
+    submit(model_choice)
+    done, _ = wait(list(attempts), timeout=hedge_delay)
+    if not done and is_provider_available(get_provider(alternate)):
+        print(f"LLM HEDGE: {model_choice} slower than {hedge_delay:.1f}s, also asking {alternate}")
+        submit(alternate)
+
+    errors = []
+    pending = set(attempts)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            attempt_model_choice, attempt_usage = attempts[future]
+            try:
+                response = future.result()
+            except Exception as e:
+                print(f"LLM HEDGE: {attempt_model_choice} failed ({e})")
+                errors.append(e)
+                continue
+            usage.update(attempt_usage)
+            usage["hedged"] = len(attempts) > 1
+            usage["failover"] = attempt_model_choice != model_choice
+            return response, attempt_model_choice
+
+    if len(attempts) == 1 and is_retryable_error(errors[0]) and is_provider_available(get_provider(alternate)):
+        print(f"LLM FAILOVER: {model_choice} failed ({errors[0]}), using {alternate}")
+        usage["failover"] = True
+        return _attempt(alternate, system_prompt, user_prompt, usage, task), alternate
+    raise errors[0]
+
+def stream_llm_response(model_choice: str, system_prompt: str, user_prompt: str, usage: dict = None, task: str = None):
+    """
+    Generator variant of call_llm_to_generate_response that yields text as it arrives.
+    Token usage is written into the optional usage dict once the stream is finished.
+    Can be passed straight to st.write_stream.
+    """
+    if usage is None:
+        usage = {}
+    model_choice = route_model_choice(model_choice, task, estimate_tokens(system_prompt, user_prompt))
+    with trace_span(
+        "llm_stream",
+        task=task,
+        provider=get_provider(model_choice),
+        model=get_model_name(model_choice),
+        prompt_chars=len(system_prompt) + len(user_prompt),
+    ) as span:
+        started = time.perf_counter()
+        response_chars = 0
+        for text in _stream_llm(model_choice, system_prompt, user_prompt, usage, task):
+            if not response_chars:
+                span["attrs"]["first_token_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            response_chars += len(text)
+            yield text
+        record_budget_usage(task, usage)
+        span["attrs"].update(usage)
+        span["attrs"]["max_tokens"] = get_sampling_params(task)["max_tokens"]
+        span["attrs"]["response_chars"] = response_chars
+
+def _stream_llm(model_choice: str, system_prompt: str, user_prompt: str, usage: dict, task: str = None):
+    cache_key = make_cache_key(model_choice, get_model_name(model_choice), system_prompt, user_prompt, get_sampling_params(task))
+    cached = get_cached_response(cache_key)
+    if cached is not None:
+        print(f"LLM CACHE HIT: {cache_key}")
+        usage.update({"input_tokens": 0, "output_tokens": 0, "cached": True})
+        yield cached
+        return
+    print(f"LLM CACHE MISS: {cache_key}")
+
+    call, is_leader = _begin_flight(cache_key)
+    if not is_leader:
+        response = _wait_flight(call)
+        if response is None:
+            response = _call_llm(model_choice, system_prompt, user_prompt, usage, task)
+        else:
+            usage.update({"input_tokens": 0, "output_tokens": 0, "coalesced": True})
+        yield response
+        return
+
+    parts = []
+    completed = False
+    attempt = 0
+    stream_model_choice = model_choice
+    alternate = get_alternate_model_choice(model_choice)
+    if alternate and not is_provider_available(get_provider(model_choice)):
+        print(f"LLM FAILOVER: {get_provider(model_choice)} circuit is open, streaming from {alternate}")
+        stream_model_choice, alternate = alternate, None
+        usage["failover"] = True
+    started = time.perf_counter()
+    try:
+        while True:
+            provider = get_provider(stream_model_choice)
+            try:
+                with provider_slot(provider, estimate_tokens(system_prompt, user_prompt)):
+                    for text in stream_provider_response(stream_model_choice, system_prompt, user_prompt, usage, task):
+                        parts.append(text)
+                        yield text
+                break
+            except Exception as e:
+                # Once text has been shown to the user we can't transparently start over.
+                if parts or not is_retryable_error(e):
+                    raise
+                if attempt >= LLM_MAX_RETRIES:
+                    if not alternate or not is_provider_available(get_provider(alternate)):
+                        raise
+                    # The retries are one call as far as the circuit breaker is concerned.
+                    if is_provider_failure(e):
+                        record_call_result(provider, False)
+                    else:
+                        release_trial(provider)
+                    if get_error_status(e) != 429:
+                        record_failure(stream_model_choice)
+                    print(f"LLM FAILOVER: {stream_model_choice} stream failed ({e}), streaming from {alternate}")
+                    stream_model_choice, alternate = alternate, None
+                    usage["failover"] = True
+                    attempt = 0
+                    continue
+                delay = get_retry_delay(e, attempt)
+                attempt += 1
+                print(f"{stream_model_choice} stream failed ({e}), retry {attempt}/{LLM_MAX_RETRIES} in {delay:.1f}s")
+                time.sleep(delay)
+        completed = True
+    except Exception as e:
+        if is_provider_failure(e):
+            record_call_result(get_provider(stream_model_choice), False)
+        if get_error_status(e) != 429:
+            record_failure(stream_model_choice)
+        _finish_flight(cache_key, call, error=e)
+        raise
+    finally:
+        if not completed:
+            # Failed with a bad request or closed early, free a half-open trial either way.
+            release_trial(get_provider(stream_model_choice))
+            # Stream closed before the end: waiters fall back to their own request.
+            if not call["event"].is_set():
+                _finish_flight(cache_key, call)
+
+    response = "".join(parts)
+    usage["cached"] = False
+    usage["used_model_choice"] = stream_model_choice
+    latency = time.perf_counter() - started
+    record_call_result(get_provider(stream_model_choice), True, latency)
+    record_observation(stream_model_choice, task, latency, usage)
+    record_token_usage(get_provider(stream_model_choice), usage.get("output_tokens"))
+    store_cached_response(
+        make_cache_key(stream_model_choice, get_model_name(stream_model_choice), system_prompt, user_prompt, get_sampling_params(task)),
+        response,
+    )
+    _finish_flight(cache_key, call, result=response)
+
+def stream_provider_response(model_choice: str, system_prompt: str, user_prompt: str, usage: dict, task: str = None):
+    """
+    Stream text chunks straight from the selected provider, bypassing cache and limits.
+    For tasks that return one code block the stream is closed at the block's closing fence.
+    """
+    streamed = ""
+    chunks = _stream_provider_chunks(model_choice, system_prompt, user_prompt, usage, task)
+    try:
+        for text in chunks:
+            end = get_code_block_end(streamed + text, task)
+            if end is not None:
+                # Anything after the block isn't code, stop generating it.
+                text = text[: end - len(streamed)]
+                streamed += text
+                yield text
+                break
+            streamed += text
+            yield text
+    finally:
+        chunks.close()
+
+    closing_fence = get_closing_fence(streamed, task)
+    if closing_fence:
+        yield closing_fence
+
+def _stream_provider_chunks(model_choice: str, system_prompt: str, user_prompt: str, usage: dict, task: str = None):
+    provider = get_provider(model_choice)
+    if provider in ("MaaS", "Local"):
+        print(f"STREAMING FROM {model_choice} MODEL")
+        chain = get_chain(model_choice, task)
+        stream = chain.stream({"system_prompt": system_prompt, "user_prompt": user_prompt})
+        try:
+            for chunk in stream:
+                # With include_usage the last chunk carries the token counts and no text.
+                if chunk.usage_metadata:
+                    usage["input_tokens"] = chunk.usage_metadata["input_tokens"]
+                    usage["output_tokens"] = chunk.usage_metadata["output_tokens"]
+                if chunk.content:
+                    yield chunk.content
+        finally:
+            # Closes the connection when the caller stops reading early.
+            stream.close()
+
+    elif provider == "Gemini":
+        print("STREAMING FROM GEMINI MODEL")
+        client = get_gemini_client(st.session_state.gemini_api_key)
+        stream = client.models.generate_content_stream(
+            model=get_model_name(model_choice),
+            contents=f"{system_prompt}\n\n{user_prompt}",
+            config=get_gemini_config(task),
         )
-        prompt_str = prompt.format_prompt(system_prompt=system_prompt, user_prompt=user_prompt)
-        print(f"DEBUG: PROMPT STR: {prompt_str.to_string()}")
-        print(f"DEBUG: Type of prompt: {type(prompt)}")
-        print(f"DEBUG: PROMPT MESSAGES: {prompt.messages}")
-        # Create LLM Chain
-        chain = prompt | llm
+        try:
+            for chunk in stream:
+                if chunk.usage_metadata:
+                    usage.update(get_gemini_usage(chunk.usage_metadata))
+                if chunk.text:
+                    yield chunk.text
+        finally:
+            stream.close()
+
+    else:
+        raise ValueError(f"Unknown model choice: {model_choice}")
+
+def call_llm_batch(requests: list, max_concurrency: int = LLM_BATCH_MAX_CONCURRENCY) -> list:
+    """
+    Run many independent prompts concurrently.
+    Each request is a dict with system_prompt, user_prompt and optionally model_choice
+    (defaults to st.session_state.model_choice) and task.
+    Returns one dict per request, in the same order, with either "response" or "error" set.
+    """
+    if not requests:
+        return []
+    default_model_choice = st.session_state.model_choice
+    # Worker threads need the script context to read st.session_state.
+    ctx = get_script_run_ctx()
+
+    def run_one(request):
+        try:
+            response = call_llm_to_generate_response(
+                request.get("model_choice", default_model_choice),
+                request["system_prompt"],
+                request["user_prompt"],
+                request.get("task"),
+            )
+            return {"response": response, "error": None}
+        except Exception as e:
+            print(f"LLM batch request failed: {e}")
+            return {"response": None, "error": e}
+
+    workers = max(1, min(max_concurrency, len(requests)))
+    with trace_span("llm_batch", requests=len(requests), concurrency=workers) as span:
+        # One context copy per request keeps the calls under the batch span.
+        trace_contexts = [copy_trace_context() for _ in requests]
+        with ThreadPoolExecutor(max_workers=workers, initializer=add_script_run_ctx, initargs=(None, ctx)) as executor:
+            results = list(executor.map(lambda trace_ctx, request: trace_ctx.run(run_one, request), trace_contexts, requests))
+        # Cache hit rate and size once per batch, rather than on every hit.
+        span["attrs"]["llm_cache"] = get_cache_stats()
+        return results
+
+def generate_response(model_choice: str, system_prompt: str, user_prompt: str, usage: dict = None, task: str = None):
+    """Call the selected provider directly, bypassing cache and rate limits. Token counts go into usage."""
+    if usage is None:
+        usage = {}
+    provider = get_provider(model_choice)
+    if provider in ("MaaS", "Local"):
+        if provider == "MaaS":
+            print(f"USING MODEL AS A SERVICE: {get_model_name(model_choice)}")
+        else:
+            print(f"USING LOCAL MODEL: {get_model_name(model_choice)} at {LOCAL_LLM_API_BASE}")
+        parser = StrOutputParser()
+        # Reuse the pooled LLM Chain
+        chain = get_chain(model_choice, task)
         response = chain.invoke({"system_prompt": system_prompt, "user_prompt": user_prompt})
-        print("\nNumber of input tokens: ", response.usage_metadata['input_tokens'])
-        print("\nNumber of output tokens: ", response.usage_metadata['output_tokens'])
+        usage["input_tokens"] = response.usage_metadata['input_tokens']
+        usage["output_tokens"] = response.usage_metadata['output_tokens']
         response = parser.invoke(response)
-        return response
+        return finish_code_block(response, task)
             
 
-    elif model_choice == "Gemini":
-        print("USING GEMINI MODEL")
+    elif provider == "Gemini":
+        print(f"USING GEMINI MODEL: {get_model_name(model_choice)}")
 
         prompt = f"{system_prompt}\n\n{user_prompt}"
-        client = genai.Client(
-            api_key=st.session_state.gemini_api_key
-        )
+        client = get_gemini_client(st.session_state.gemini_api_key)
 
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt
-        )
+        # Limits and retries are already applied by the caller, use the async client directly.
+        response = run_coroutine(client.aio.models.generate_content(
+            model=get_model_name(model_choice),
+            contents=prompt,
+            config=get_gemini_config(task),
+        ))
 
-        print(response.text)
-        return response.text
+        if response.usage_metadata:
+            usage.update(get_gemini_usage(response.usage_metadata))
+        if not response.text:
+            finish_reason = response.candidates[0].finish_reason if response.candidates else None
+            raise ValueError(f"Gemini returned no text for task {task} (finish reason: {finish_reason}, usage: {usage})")
+        return finish_code_block(response.text, task)
 
     else:
-        print("USING LOCAL MODEL")
-        print("LOCAL MODEL NOT CONFIGURED YET")
-        return "LOCAL MODEL NOT CONFIGURED YET"
+        raise ValueError(f"Unknown model choice: {model_choice}")
         
 
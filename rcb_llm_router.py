@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Kinds of output we ask the LLM for. Callers pass one of these as task.
+TASK_CLASSES = ["outline", "page_summary", "detailed_content", "transcript_curation", "d2_code", "chat"]
+
+# Optional smaller/faster models, only used by the router when configured.
+MAAS_SMALL_MODEL_NAME = os.environ.get("MAAS_SMALL_MODEL_NAME")
+GEMINI_SMALL_MODEL_NAME = os.environ.get("GEMINI_SMALL_MODEL_NAME", "gemini-2.5-flash-lite")
+
+# Relative cost per 1000 tokens (input + output) used to compare candidates.
+# Override with LLM_MODEL_COSTS='{"MaaS": 1.0, "Gemini:gemini-2.5-flash-lite": 0.1}'
+MODEL_COSTS = {
+    "MaaS": 1.0,
+    "Gemini": 0.6,
+    f"Gemini:{GEMINI_SMALL_MODEL_NAME}": 0.1,
+    "Local": 0.0,
+}
+if MAAS_SMALL_MODEL_NAME:
+    MODEL_COSTS[f"MaaS:{MAAS_SMALL_MODEL_NAME}"] = 0.2
+MODEL_COSTS.update(json.loads(os.getenv("LLM_MODEL_COSTS", "{}")))
+
+def _small_models() -> list:
+    models = []
+    if MAAS_SMALL_MODEL_NAME:
+        models.append(f"MaaS:{MAAS_SMALL_MODEL_NAME}")
+    if os.environ.get("GEMINI_API_KEY"):
+        models.append(f"Gemini:{GEMINI_SMALL_MODEL_NAME}")
+    return models
+
+# Candidate models per task, in order of preference, and the p95 latency budget (seconds).
+# Short outputs may go to a small model, long-form content stays on the large one.
+# Override with LLM_ROUTES='{"chat": {"candidates": ["Local", "MaaS"], "latency_budget": 10}}'
+TASK_ROUTES = {
+    "outline": {"candidates": ["MaaS"], "latency_budget": 60},
+    "page_summary": {"candidates": _small_models() + ["MaaS"], "latency_budget": 20},
+    "detailed_content": {"candidates": ["MaaS"], "latency_budget": 180},
+    "transcript_curation": {"candidates": _small_models() + ["MaaS"], "latency_budget": 30},
+    "d2_code": {"candidates": _small_models() + ["MaaS"], "latency_budget": 20},
+    "chat": {"candidates": _small_models() + ["MaaS"], "latency_budget": 15},
+}
+TASK_ROUTES.update(json.loads(os.getenv("LLM_ROUTES", "{}")))
+DEFAULT_ROUTE = {"candidates": ["MaaS"], "latency_budget": 120}
+
+# Number of recent calls kept per (model, task) to compute latency percentiles.
+LLM_STATS_WINDOW = int(os.getenv("LLM_STATS_WINDOW", "50"))
+
+# A candidate whose last LLM_ROUTER_MAX_FAILURES calls failed (bad key, unknown model
+# name, outage) is skipped for LLM_ROUTER_FAILURE_COOLDOWN seconds.
+LLM_ROUTER_MAX_FAILURES = int(os.getenv("LLM_ROUTER_MAX_FAILURES", "2"))
+LLM_ROUTER_FAILURE_COOLDOWN = float(os.getenv("LLM_ROUTER_FAILURE_COOLDOWN", "300"))
+
+_observations = {}
+_failures = {}
+_observations_lock = threading.Lock()
+
+def record_observation(model_choice: str, task: str, latency: float, usage: dict):
+    """Record latency (seconds) and token usage of a call that reached the provider."""
+    tokens = (usage.get("input_tokens") or 0) + (usage.get("output_tokens") or 0)
+    with _observations_lock:
+        _failures.pop(model_choice, None)
+        for key in ((model_choice, task), (model_choice, None)):
+            if key not in _observations:
+                _observations[key] = deque(maxlen=LLM_STATS_WINDOW)
+            _observations[key].append((latency, tokens))
+
+def record_failure(model_choice: str):
+    """Record a call to model_choice that failed after its retries."""
+    with _observations_lock:
+        count, _ = _failures.get(model_choice, (0, 0.0))
+        _failures[model_choice] = (count + 1, time.monotonic())
+
+def is_failing(model_choice: str) -> bool:
+    with _observations_lock:
+        count, failed_at = _failures.get(model_choice, (0, 0.0))
+    return count >= LLM_ROUTER_MAX_FAILURES and time.monotonic() - failed_at < LLM_ROUTER_FAILURE_COOLDOWN
+
+def _percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+def get_latency_stats(model_choice: str, task: str = None) -> dict:
+    """p50/p95 latency and mean tokens of recent calls, or None without observations."""
+    with _observations_lock:
+        samples = list(_observations.get((model_choice, task), ()))
+    if not samples:
+        return None
+    latencies = [sample[0] for sample in samples]
+    return {
+        "count": len(samples),
+        "p50": _percentile(latencies, 0.5),
+        "p95": _percentile(latencies, 0.95),
+        "mean_tokens": sum(sample[1] for sample in samples) / len(samples),
+    }
+
+def estimate_cost(model_choice: str, tokens: float) -> float:
+    cost = MODEL_COSTS.get(model_choice, MODEL_COSTS.get(model_choice.partition(":")[0], 1.0))
+    return cost * tokens / 1000
+
+def choose_model(task: str, estimated_tokens: int = 0) -> str:
+    """
+    Pick the cheapest candidate for task whose observed p95 latency fits the task's budget.
+    Candidates without observations are tried as they come, so every model gets measured.
+    If no candidate fits, the one with the lowest p95 wins. Candidates that keep failing are skipped.
+    """
+    route = TASK_ROUTES.get(task, DEFAULT_ROUTE)
+    candidates = route["candidates"] or DEFAULT_ROUTE["candidates"]
+    healthy = [model_choice for model_choice in candidates if not is_failing(model_choice)]
+    # With every candidate failing, the last (largest) one is the best bet.
+    candidates = healthy or candidates[-1:]
+    within_budget = []
+    fallback = None
+    for model_choice in candidates:
+        stats = get_latency_stats(model_choice, task)
+        if stats is None:
+            return model_choice
+        tokens = stats["mean_tokens"] or estimated_tokens
+        if stats["p95"] <= route["latency_budget"]:
+            within_budget.append((estimate_cost(model_choice, tokens), stats["p50"], model_choice))
+        if fallback is None or stats["p95"] < fallback[0]:
+            fallback = (stats["p95"], model_choice)
+    if within_budget:
+        return min(within_budget)[2]
+    return fallback[1]
+
+def route_model_choice(model_choice: str, task: str, estimated_tokens: int = 0) -> str:
+    """Resolve "Auto" to a concrete model for task, any other choice is kept as is."""
+    if model_choice != "Auto":
+        return model_choice
+    routed = choose_model(task, estimated_tokens)
+    print(f"LLM ROUTER: task {task} -> {routed}")
+    return routed
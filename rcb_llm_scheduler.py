@@ -0,0 +1,238 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
+import httpx
+import openai
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Per-provider limits: requests/min, tokens/min and number of calls in flight.
+# Shared by every session in this process so that several QuickCourse runs
+# slow down together instead of tripping the provider's throttling.
+PROVIDER_LIMITS = {
+    "MaaS": {
+        "rpm": int(os.getenv("MAAS_REQUESTS_PER_MINUTE", "60")),
+        "tpm": int(os.getenv("MAAS_TOKENS_PER_MINUTE", "200000")),
+        "concurrency": int(os.getenv("MAAS_MAX_CONCURRENCY", "8")),
+    },
+    "Gemini": {
+        "rpm": int(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "60")),
+        "tpm": int(os.getenv("GEMINI_TOKENS_PER_MINUTE", "250000")),
+        "concurrency": int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")),
+    },
+    "Local": {
+        "rpm": int(os.getenv("LOCAL_REQUESTS_PER_MINUTE", "600")),
+        "tpm": int(os.getenv("LOCAL_TOKENS_PER_MINUTE", "1000000")),
+        "concurrency": int(os.getenv("LOCAL_MAX_CONCURRENCY", "4")),
+    },
+}
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "30"))
+
+class TokenBucket:
+    """Token bucket refilled continuously at capacity per minute."""
+
+    def __init__(self, capacity: int):
+        self.capacity = float(capacity)
+        self.rate = capacity / 60.0
+        self.available = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, amount: float) -> float:
+        """Take amount if it is available and return 0, otherwise return the seconds to wait."""
+        # A single request larger than the bucket would never fit, cap it.
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self._refill()
+            if self.available >= amount:
+                self.available -= amount
+                return 0
+            return (amount - self.available) / self.rate
+
+    def acquire(self, amount: float):
+        """Block until amount can be taken from the bucket."""
+        while True:
+            wait = self.try_acquire(amount)
+            if not wait:
+                return
+            time.sleep(min(wait, 5))
+
+    def consume(self, amount: float):
+        """Take amount without waiting, the balance may go negative."""
+        with self.lock:
+            self._refill()
+            self.available -= amount
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def _get_limiter(provider: str) -> dict:
+    with _limiters_lock:
+        if provider not in _limiters:
+            limits = PROVIDER_LIMITS.get(provider, PROVIDER_LIMITS["MaaS"])
+            _limiters[provider] = {
+                "requests": TokenBucket(limits["rpm"]),
+                "tokens": TokenBucket(limits["tpm"]),
+                "slots": threading.BoundedSemaphore(limits["concurrency"]),
+            }
+        return _limiters[provider]
+
+def estimate_tokens(*texts) -> int:
+    # Rough estimate, ~4 characters per token.
+    return sum(len(text) for text in texts if text) // 4 + 1
+
+@contextmanager
+def provider_slot(provider: str, estimated_tokens: int):
+    """Wait for rate limit budget and a free concurrency slot for provider."""
+    limiter = _get_limiter(provider)
+    limiter["requests"].acquire(1)
+    limiter["tokens"].acquire(estimated_tokens)
+    with limiter["slots"]:
+        yield
+
+@asynccontextmanager
+async def async_provider_slot(provider: str, estimated_tokens: int):
+    """provider_slot for coroutines, waits with asyncio.sleep so the event loop keeps running."""
+    limiter = _get_limiter(provider)
+    for bucket, amount in ((limiter["requests"], 1), (limiter["tokens"], estimated_tokens)):
+        while True:
+            wait = bucket.try_acquire(amount)
+            if not wait:
+                break
+            await asyncio.sleep(min(wait, 5))
+    # Same semaphore as the threaded callers, so both count against one concurrency limit.
+    while not limiter["slots"].acquire(blocking=False):
+        await asyncio.sleep(0.05)
+    try:
+        yield
+    finally:
+        limiter["slots"].release()
+
+def record_token_usage(provider: str, tokens: int):
+    """Charge tokens that were only known after the call (e.g. output tokens)."""
+    if tokens:
+        _get_limiter(provider)["tokens"].consume(tokens)
+
+def get_error_status(e: Exception):
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(e, "code", None)
+    return status if isinstance(status, int) else None
+
+def is_retryable_error(e: Exception) -> bool:
+    """429, 5xx and connection problems are worth retrying, anything else is not."""
+    status = get_error_status(e)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(e, (openai.APIConnectionError, httpx.TimeoutException, httpx.TransportError))
+
+def is_provider_failure(e: Exception) -> bool:
+    """5xx and connection problems count against the provider's health, throttling (429) and bad requests don't."""
+    return is_retryable_error(e) and get_error_status(e) != 429
+
+def get_retry_delay(e: Exception, attempt: int) -> float:
+    # Honour the provider's Retry-After when it sends one.
+    response = getattr(e, "response", None)
+    retry_after = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), LLM_RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    # Exponential backoff with full jitter.
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+
+def run_with_retry(provider: str, estimated_tokens: int, fn):
+    """Run fn under the provider's limits, retrying throttling and server errors with backoff."""
+    attempt = 0
+    while True:
+        try:
+            with provider_slot(provider, estimated_tokens):
+                return fn()
+        except Exception as e:
+            if attempt >= LLM_MAX_RETRIES or not is_retryable_error(e):
+                raise
+            delay = get_retry_delay(e, attempt)
+            attempt += 1
+            print(f"{provider} call failed ({e}), retry {attempt}/{LLM_MAX_RETRIES} in {delay:.1f}s")
+            time.sleep(delay)
+
+async def run_with_retry_async(provider: str, estimated_tokens: int, coro_fn):
+    """run_with_retry for coroutines, coro_fn is called again for every attempt."""
+    attempt = 0
+    while True:
+        try:
+            async with async_provider_slot(provider, estimated_tokens):
+                return await coro_fn()
+        except Exception as e:
+            if attempt >= LLM_MAX_RETRIES or not is_retryable_error(e):
+                raise
+            delay = get_retry_delay(e, attempt)
+            attempt += 1
+            print(f"{provider} call failed ({e}), retry {attempt}/{LLM_MAX_RETRIES} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+# Circuit breaker per provider. After CIRCUIT_FAILURE_THRESHOLD consecutive failed
+# (or slower than CIRCUIT_SLOW_CALL_SECONDS) calls the provider is skipped for
+# CIRCUIT_COOLDOWN_SECONDS, then a single trial call decides whether it is back.
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv("CIRCUIT_COOLDOWN_SECONDS", "60"))
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "300"))
+
+_circuits = {}
+_circuits_lock = threading.Lock()
+
+def _get_circuit(provider: str) -> dict:
+    if provider not in _circuits:
+        _circuits[provider] = {"state": "closed", "failures": 0, "opened_at": 0.0, "trial_running": False}
+    return _circuits[provider]
+
+def is_provider_available(provider: str) -> bool:
+    """False while the provider's circuit is open. Lets one trial call through after the cooldown."""
+    with _circuits_lock:
+        circuit = _get_circuit(provider)
+        if circuit["state"] == "closed":
+            return True
+        if circuit["state"] == "open" and time.monotonic() - circuit["opened_at"] >= CIRCUIT_COOLDOWN_SECONDS:
+            circuit["state"] = "half-open"
+        if circuit["state"] == "half-open" and not circuit["trial_running"]:
+            circuit["trial_running"] = True
+            return True
+        return False
+
+def release_trial(provider: str):
+    """End a call that says nothing about the provider's health (bad request, abandoned stream) without changing the circuit state."""
+    with _circuits_lock:
+        _get_circuit(provider)["trial_running"] = False
+
+def record_call_result(provider: str, success: bool, latency: float = 0.0):
+    """Feed the outcome of one provider call into its circuit breaker."""
+    failed = not success or latency > CIRCUIT_SLOW_CALL_SECONDS
+    with _circuits_lock:
+        circuit = _get_circuit(provider)
+        circuit["trial_running"] = False
+        if not failed:
+            if circuit["state"] != "closed":
+                print(f"CIRCUIT CLOSED: {provider} is healthy again")
+            circuit["state"] = "closed"
+            circuit["failures"] = 0
+            return
+        circuit["failures"] += 1
+        if circuit["state"] == "half-open" or circuit["failures"] >= CIRCUIT_FAILURE_THRESHOLD:
+            if circuit["state"] != "open":
+                print(f"CIRCUIT OPEN: routing around {provider} for {CIRCUIT_COOLDOWN_SECONDS}s")
+            circuit["state"] = "open"
+            circuit["opened_at"] = time.monotonic()
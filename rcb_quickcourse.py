@@ -9,7 +9,7 @@ from io import StringIO
 
 
 from rcb_init import init_page, init_llm_vars, init_quickcourse_page, add_log, init_quickcourse_vars, init_quickcourse_prompts
-from rcb_llm_manager import call_llm_to_generate_response
+from rcb_llm_manager import call_llm_to_generate_response, call_llm_batch, get_budget_report
 from rcb_rag_manager import retrieve_context
     
 def extract_code_blocks(text):
@@ -77,6 +77,8 @@ def read_chapter_list(course_structure_csv):
     sections = []
     chapter_name = ""
     section_name = ""
+    # Pages are laid out while reading the CSV, their content is generated afterwards in one batch.
+    page_jobs = []
     print(f"DEBUG: Reading chapter list from {st.session_state.course_structure_csv}...")
     try:
         with open(st.session_state.course_structure_csv, newline='', encoding='utf-8') as f:
@@ -129,12 +131,15 @@ def read_chapter_list(course_structure_csv):
                         st.session_state.context_from_rag = retrieve_context(text)
 
                         print("BUILDING PAGE SUMMARY")
-                        st.session_state.progress_logs.info(f"Building page summary for topic: {text}")
+                        st.session_state.progress_logs.info(f"Preparing page summary for topic: {text}")
                         init_quickcourse_prompts() # Re-initialize prompts to update context and topics
-                        response = call_llm_to_generate_response(st.session_state.model_choice, st.session_state.system_prompt_page_summary, st.session_state.user_prompt_page_summary)
-                        print("PAGE SUMMARY: ", response)
-                        f.write("\n\n")
-                        f.write(response)
+                        page_jobs.append({
+                            "path": section_path_page,
+                            "topic": text,
+                            "task": "page_summary",
+                            "system_prompt": st.session_state.system_prompt_page_summary,
+                            "user_prompt": st.session_state.user_prompt_page_summary,
+                        })
 
                 if row and row[0].strip().startswith('-') and len(row) > 1:
                     section_name = row[1].strip()
@@ -148,27 +153,43 @@ def read_chapter_list(course_structure_csv):
                         st.session_state.context_from_rag = retrieve_context(text)
 
                         print("BUILDING PAGE CONTENT")
-                        st.session_state.progress_logs.info(f"Building page content for topic: {text}")
+                        st.session_state.progress_logs.info(f"Preparing page content for topic: {text}")
 
-
-                        print("BUILDING PAGE SUMMARY")
-                        st.session_state.progress_logs.info(f"Building page summary for topic: {text}")
-                        
                         init_quickcourse_prompts() # Re-initialize prompts to update context and topics
-                        response = call_llm_to_generate_response(st.session_state.model_choice, st.session_state.system_prompt_detailed_content, st.session_state.user_prompt_detailed_content)
-                        print("PAGE SUMMARY: ", response)
-                        ##st.write(response)
-                        f.write("\n\n")
-                        f.write(response)
+                        page_jobs.append({
+                            "path": page_section_adoc,
+                            "topic": text,
+                            "task": "detailed_content",
+                            "system_prompt": st.session_state.system_prompt_detailed_content,
+                            "user_prompt": st.session_state.user_prompt_detailed_content,
+                        })
 
                     with open(section_path_nav, 'a') as f:
                         f.write(f"** xref:{section_name}.adoc[]"+'\n')
-            
-                
+
+        write_page_contents(page_jobs)
+
     except FileNotFoundError:
         print(f"CSV file '{st.session_state.course_structure_csv}' not found.")
     return chapters
 
+def write_page_contents(page_jobs):
+    """Generate the content of all pages concurrently and append it to the page files."""
+    if not page_jobs:
+        return
+    st.session_state.progress_logs.info(f"Generating content for {len(page_jobs)} pages...")
+    results = call_llm_batch(page_jobs)
+    for job, result in zip(page_jobs, results):
+        if result["error"] is not None:
+            add_log(f"Failed to generate content for topic '{job['topic']}': {result['error']}")
+            st.session_state.progress_logs.warning(f"Failed to generate content for topic: {job['topic']}")
+            continue
+        print("PAGE CONTENT: ", result["response"])
+        with open(job["path"], 'a') as f:
+            f.write("\n\n")
+            f.write(result["response"])
+    print(f"LLM BUDGET REPORT: {get_budget_report()}")
+
 # --- Render antora.yml template ---
 def generate_antora_yml():
     chapters = read_chapter_list(st.session_state.course_structure_csv)
@@ -1,10 +1,17 @@
 import streamlit as st
 import hashlib
+import math
 import os
+import re
 import shutil
+import threading
+import time
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 ##Use doclin instead of below
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_text_splitters import MarkdownHeaderTextSplitter
 from langchain_ollama import OllamaEmbeddings
@@ -21,10 +28,106 @@ from docling.chunking import HybridChunker
 from pathlib import Path
 import json
 
-def get_embedding():
-    return HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-mpnet-base-v2"
-    )
+from rcb_trace import trace_span, collect_spans, record_spans
+from rcb_embedding_service import BatchingEmbeddings, QUERY_PRIORITY
+from rcb_embedding_cache import CachedEmbeddings
+from rcb_document_converter import convert_document, chunk_document, extract_text_fast, warm_up_converters
+import rcb_lexical_index as lexical_index
+from rcb_context_packer import pack_context, count_tokens
+from rcb_upload_manifest import save_and_hash, get_upload, record_upload, list_uploads, delete_uploads, get_manifest_path
+from langchain_core.documents import Document
+
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-mpnet-base-v2")
+
+# Chunks embedded and upserted into the vectorstore per call.
+EMBEDDING_UPSERT_BATCH_SIZE = int(os.getenv("EMBEDDING_UPSERT_BATCH_SIZE", "256"))
+
+# Worker processes converting and chunking uploads, shared by all sessions.
+# Each worker keeps its own warm docling converters (see rcb_document_converter).
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) // 2)))))
+_ingest_pool = None
+_ingest_pool_lock = threading.Lock()
+_ingest_pool_warm_up_started = False
+
+# Hybrid retrieval: vector and BM25 candidates merged by reciprocal rank fusion.
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "true").lower() == "true"
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "4"))
+# Candidates taken from each search before fusion.
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", "20"))
+RRF_K = 60
+
+# Optional extractive compression: only the retrieved sentences closest to the
+# query are kept, up to CONTEXT_COMPRESSION_RATIO of the packed context's tokens.
+CONTEXT_COMPRESSION = os.getenv("CONTEXT_COMPRESSION", "false").lower() == "true"
+CONTEXT_COMPRESSION_RATIO = float(os.getenv("CONTEXT_COMPRESSION_RATIO", "0.4"))
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+|\n+")
+
+# Retrieved contexts per (user index version, query, options), least recently used evicted first.
+# Set RETRIEVAL_CACHE_SIZE=0 to disable.
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "256"))
+_retrieval_cache = OrderedDict()
+_index_versions = {}
+_retrieval_cache_lock = threading.Lock()
+
+# Process-wide embedding models, loaded once and shared by all Streamlit sessions.
+_embeddings = {}
+_embeddings_lock = threading.Lock()
+_embedding_warm_up_started = False
+
+def get_index_version(user_dir):
+    with _retrieval_cache_lock:
+        return _index_versions.get(user_dir, 0)
+
+def bump_index_version(user_dir):
+    """Mark the user's RAG db as changed, earlier cached retrievals no longer match."""
+    with _retrieval_cache_lock:
+        _index_versions[user_dir] = _index_versions.get(user_dir, 0) + 1
+        for key in [key for key in _retrieval_cache if key[0] == user_dir]:
+            del _retrieval_cache[key]
+
+def get_cached_retrieval(key):
+    with _retrieval_cache_lock:
+        if key not in _retrieval_cache:
+            return None
+        _retrieval_cache.move_to_end(key)
+        return _retrieval_cache[key]
+
+def store_retrieval(key, context):
+    if RETRIEVAL_CACHE_SIZE <= 0:
+        return
+    with _retrieval_cache_lock:
+        # Skip results computed against an index that changed in the meantime.
+        if key[1] != _index_versions.get(key[0], 0):
+            return
+        _retrieval_cache[key] = context
+        _retrieval_cache.move_to_end(key)
+        while len(_retrieval_cache) > RETRIEVAL_CACHE_SIZE:
+            _retrieval_cache.popitem(last=False)
+
+def normalize_query(query):
+    return " ".join(query.split()).casefold()
+
+def get_embedding(model_name: str = EMBEDDING_MODEL_NAME):
+    """
+    Return the resident embedding model, loading it on first use.
+    Calls are queued to the model's embedding service and run in micro-batches with other sessions' calls.
+    """
+    with _embeddings_lock:
+        if model_name not in _embeddings:
+            print(f"Loading embedding model: {model_name}")
+            _embeddings[model_name] = CachedEmbeddings(BatchingEmbeddings(HuggingFaceEmbeddings(
+                model_name=model_name
+            )), model_name)
+        return _embeddings[model_name]
+
+def warm_up_embedding():
+    """Load the embedding model in the background at startup, so the first upload or retrieval doesn't wait for it."""
+    global _embedding_warm_up_started
+    with _embeddings_lock:
+        if _embedding_warm_up_started:
+            return
+        _embedding_warm_up_started = True
+    threading.Thread(target=lambda: get_embedding().embed_query("warm up"), name="embedding-warm-up", daemon=True).start()
 
 def is_supported_metadata_value(value):
     # Chroma accepts simple scalars, lists of scalars, and None.
@@ -71,10 +174,52 @@ def sanitize_metadata(metadata):
     return sanitized
 
 
+def get_ingest_pool() -> ProcessPoolExecutor:
+    global _ingest_pool
+    with _ingest_pool_lock:
+        if _ingest_pool is None:
+            print(f"Starting ingestion pool with {INGEST_WORKERS} worker process(es)")
+            # spawn: forking a process that already runs torch/streamlit threads is unsafe.
+            # Every worker starts loading its docling converters as soon as it is up.
+            _ingest_pool = ProcessPoolExecutor(
+                max_workers=INGEST_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=warm_up_converters,
+            )
+        return _ingest_pool
+
+def submit_ingest(fn, *args):
+    """Submit to the ingestion pool, starting a fresh pool if the old one broke while idle."""
+    try:
+        return get_ingest_pool().submit(fn, *args)
+    except BrokenProcessPool:
+        reset_ingest_pool()
+        return get_ingest_pool().submit(fn, *args)
+
+def warm_up_ingest_pool():
+    """Start the ingestion workers at startup, so the first upload finds warm converters."""
+    global _ingest_pool_warm_up_started
+    with _ingest_pool_lock:
+        if _ingest_pool_warm_up_started:
+            return
+        _ingest_pool_warm_up_started = True
+    # Workers are spawned on the first submit.
+    submit_ingest(os.getpid)
+
+def reset_ingest_pool():
+    """Drop a pool whose worker died (e.g. killed on OOM), the next upload starts a fresh one."""
+    global _ingest_pool
+    with _ingest_pool_lock:
+        if _ingest_pool is not None:
+            _ingest_pool.shutdown(wait=False, cancel_futures=True)
+            _ingest_pool = None
+
 def process_uploaded_documents(uploaded_files):
+    """Ingest the uploads. Returns the outcome per file name: SUCCESS, FAILED or DUPLICATE (already ingested)."""
     print(f"Processing {len(uploaded_files)} uploaded files...")
+    results = {}
     if not uploaded_files:
-        return
+        return results
     total_files = len(uploaded_files)
     progress_bar = st.progress(0)
     status_placeholder = st.empty()
@@ -82,95 +227,119 @@ def process_uploaded_documents(uploaded_files):
     processed_files = 0
     
     # try:
-    for i, uploaded_file in enumerate(uploaded_files):
-        progress = (i + 1) / total_files
-        progress_bar.progress(progress)
-        status_placeholder.text(f"Processing {i + 1} of {total_files}: {uploaded_file.name}")
-        if not file_already_uploaded(uploaded_file):
+    with trace_span("ingest_documents", files=total_files, workers=INGEST_WORKERS) as span:
+        file_paths = []
+        digests = {}
+        for uploaded_file in uploaded_files:
             print(f"Saving {uploaded_file.name}...")
-            ### Save uploaded file
-            file_path = save_uploaded_file(uploaded_file)
-            ### Generate RAG db for the uploaded file
-            st.toast(f"Generating RAG db for file: {uploaded_file.name}")
-            if generate_rag_db(file_path):
-                st.toast(f"Converting {uploaded_file.name} to markdown format...")
-            if generate_markdown_file(file_path):
-                record_file_hash(file_path,"SUCCESS")
+            ### Save uploaded file, skipped if the same content was already ingested
+            file_path, digest = save_uploaded_file(uploaded_file)
+            if file_path:
+                file_paths.append(file_path)
+                digests[file_path] = digest
             else:
-                record_file_hash(file_path,"FAILED")
+                print(f"File {uploaded_file.name} already available, ignoring it...")
+                results[uploaded_file.name] = "DUPLICATE"
+
+        # Convert and chunk in worker processes, embed and write to the vectorstore here,
+        # one file at a time, as the conversions finish. Each file is two progress steps.
+        total_steps = max(1, 2 * len(file_paths))
+        steps_done = 0
+        futures = {submit_ingest(convert_and_split, file_path): file_path for file_path in file_paths}
+        status_placeholder.text(f"Converting {len(file_paths)} file(s)...")
+        for future in as_completed(futures):
+            file_path = futures[future]
+            file_name = os.path.basename(file_path)
+            steps_done += 1
+            progress_bar.progress(steps_done / total_steps)
+            try:
+                result = future.result()
+                # Conversion spans were collected in the worker, add them to this user's trace.
+                record_spans(result["spans"])
+                status_placeholder.text(f"Generating RAG db for file {processed_files + 1} of {len(file_paths)}: {file_name}")
+                write_markdown_file(file_path, result["markdown"])
+                add_to_rag_db(result["chunks"], file_name)
+                record_file_hash(file_path, digests[file_path], "SUCCESS", len(result["chunks"]))
+                # A new version of a file replaces the manifest entry of the old one.
+                delete_uploads(st.session_state.user_dir, file_name, keep_digest=digests[file_path])
+                results[file_name] = "SUCCESS"
+            except Exception as e:
+                print(f"Failed to ingest {file_name}: {e}")
+                st.toast(f"Failed to process {file_name}")
+                if isinstance(e, BrokenProcessPool):
+                    reset_ingest_pool()
+                record_file_hash(file_path, digests[file_path], "FAILED")
+                results[file_name] = "FAILED"
+            steps_done += 1
+            progress_bar.progress(steps_done / total_steps)
             processed_files += 1
-            ##time.sleep(1)
-        else:
-            print(f"File {uploaded_file.name} already available, ignoring it...")
+        span["attrs"]["processed"] = processed_files
 
+    progress_bar.progress(1.0)
     status_placeholder.text(f"{processed_files} file(s) processed")
+    return results
 
     # except Exception as e:
     #     st.error(f"Error during processing: {str(e)}")
 
-def save_uploaded_file(uploaded_file) -> str:
-    ## Save an uploaded file to the uploads directory
+def save_uploaded_file(uploaded_file):
+    """
+    Save an uploaded file to the uploads directory, hashing it in the same pass.
+    Returns (file_path, digest), file_path is None if the same content was already ingested.
+    """
     if not os.path.exists(f"{st.session_state.user_dir}/uploads"):
         os.makedirs(f"{st.session_state.user_dir}/uploads")
 
     file_path = os.path.join(f"{st.session_state.user_dir}/uploads/",uploaded_file.name)
+    partial_path = f"{file_path}.partial"
     print(f"SAVING UPLOADED FILE TO: {file_path}")
-    with open(file_path, "wb") as f:
-        f.write(uploaded_file.getvalue())
-
-    return file_path
-
-def record_file_hash(file_path,status):
-    file_name = os.path.basename(file_path)
-    hasher = hashlib.md5()
-    with open(file_path, 'rb') as f:
-        buf = f.read()
-        hasher.update(buf)
-    file_hash = hasher.hexdigest()
-
-    # hash_record_path = os.path.join(f"{st.session_state.user_dir}/file_hashes/", os.path.basename(file_path) + ".hash")
-    with open(f"{st.session_state.user_dir}/uploads-hash.txt", "a") as f:
-        f.write(os.path.basename(file_path))
-        f.write("\t")
-        f.write(status)
-        f.write("\t")
-        f.write(file_hash)
-        f.write("\n")
-
-    print(f"Recorded hash for {file_path}: {file_hash}")
-    return file_hash
-
-def file_already_uploaded(uploaded_file):
-    print(f"Checking hash for file: {uploaded_file.name}")
-    hasher = hashlib.md5()
-    buf = uploaded_file.getvalue()
-    hasher.update(buf)
-    file_hash = hasher.hexdigest()
-    print(f"md5sum of the uploaded file {uploaded_file.name} is {file_hash}")
-    try:
-        with open(f"{st.session_state.user_dir}/uploads-hash.txt", "r") as f:
-            content = f.read()
-            return file_hash in content
-    except Exception as e:
-        return False
-
-@st.dialog("List of contents added in RAG database")
-def show_file_content_dialog(filepath):
-    try:
-        with open(filepath, "r") as f:
-            content = f.read()
-        #st.subheader(f"Content of: {filepath}")
-        st.code(content, language="text") # Use st.code for raw text content
-    except FileNotFoundError:
-        st.error(f"File not found: {filepath}")
+    digest = save_and_hash(uploaded_file, partial_path)
+    if file_already_uploaded(uploaded_file.name, digest):
+        os.remove(partial_path)
+        return None, digest
+    os.replace(partial_path, file_path)
+    return file_path, digest
+
+def record_file_hash(file_path, digest, status, chunk_count=None):
+    record_upload(st.session_state.user_dir, digest, os.path.basename(file_path), status, chunk_count, os.path.getsize(file_path))
+    print(f"Recorded hash for {file_path}: {digest} {status}")
+    return digest
+
+def file_already_uploaded(file_name, digest):
+    print(f"sha256 of the uploaded file {file_name} is {digest}")
+    upload = get_upload(st.session_state.user_dir, digest)
+    # Failed ingestions are retried.
+    return upload is not None and upload["status"] == "SUCCESS"
+
+@st.dialog("List of contents added in RAG database", width="large")
+def show_uploads_dialog():
+    uploads = list_uploads(st.session_state.user_dir)
+    if not uploads:
+        st.info("No documents uploaded yet.")
+        return
+    st.dataframe(
+        [
+            {
+                "File": upload["file_name"],
+                "Status": upload["status"],
+                "Chunks": upload["chunk_count"],
+                "Size (KB)": round((upload["size"] or 0) / 1024, 1),
+                "Added": time.strftime("%Y-%m-%d %H:%M", time.localtime(upload["created_at"])),
+                "Digest": upload["digest"][:12],
+            }
+            for upload in uploads
+        ],
+        hide_index=True,
+    )
 
 @st.dialog("Are you sure you want to clear all uploaded data? This can't be undone.")
 def clear_uploaded_content():
     if st.button("Yes"):
         for dir in ["uploads", "rag_db"]:
             dir_to_delete = os.path.join(st.session_state.user_dir, dir)
-            files_to_delete = os.path.join(st.session_state.user_dir, f"uploads-hash.txt")
-            os.remove(files_to_delete) if os.path.exists(files_to_delete) else None
+            for file_name in ["uploads-hash.txt", "uploads-hash.txt.imported", os.path.basename(get_manifest_path(st.session_state.user_dir))]:
+                files_to_delete = os.path.join(st.session_state.user_dir, file_name)
+                os.remove(files_to_delete) if os.path.exists(files_to_delete) else None
 
             # Delete hash file if exists
             if os.path.exists(dir_to_delete):
@@ -181,29 +350,39 @@ def clear_uploaded_content():
                     print(f"Error deleting directory {dir_to_delete}: {e}")
             else:
                 print(f"Directory not found: {dir_to_delete}")
+        st.session_state.vectorstore = None
+        bump_index_version(st.session_state.user_dir)
         st.rerun()
     else:
         pass
 
-def generate_markdown_file(file_path):
-    converter = DocumentConverter()
-    result = converter.convert(file_path)
-    markdown_content = result.document.export_to_markdown()
+def write_markdown_file(file_path, markdown_content):
     with open(f"{file_path}.md", "w") as f:
         f.write(markdown_content)
     return True
 
-def generate_rag_db(file_path):
-    # loader = DoclingLoader(file_path, export_type=ExportType.MARKDOWN, chunker=HybridChunker(tokenizer="sentence-transformers/all-MiniLM-L6-v2"))
-    TOP_K = 3
-    MILVUS_URI = f"{st.session_state.user_dir}/rag_db/rag_db.db"
-    EMBEDDING_MODEL = "sentence-transformers/multi-qa-mpnet-base-dot-v1"
-
-    # loader = DoclingLoader(file_path, export_type=ExportType.DOC_CHUNKS, chunker=HybridChunker(tokenizer=EMBEDDING_MODEL))
-
-    loader = DoclingLoader(file_path=file_path)
-    document = loader.load()
-
+def convert_and_split(file_path):
+    """
+    Ingestion worker: convert file_path once and return its markdown export and the chunks to embed.
+    Runs in a worker process, so it must not touch st.session_state.
+    Its trace spans are returned with the result, the session writes them to the user's trace.
+    """
+    with collect_spans() as spans:
+        with trace_span("ingest_convert", file=os.path.basename(file_path)) as span:
+            markdown_content = extract_text_fast(file_path)
+            span["attrs"]["fast_path"] = markdown_content is not None
+            if markdown_content is not None:
+                print(f"Fast path ingestion for {file_path}")
+                chunks = split_for_embedding([Document(page_content=markdown_content, metadata={"source": file_path})])
+            else:
+                document = convert_document(file_path)
+                markdown_content = document.export_to_markdown()
+                chunks = split_for_embedding(chunk_document(document, file_path))
+            span["attrs"]["chunks"] = len(chunks)
+    return {"markdown": markdown_content, "chunks": chunks, "spans": spans}
+
+def split_for_embedding(document):
+    """Split docling chunks further by markdown headers and size, to fit the embedding model."""
     headers_to_split_on = [
         ("#", "Header 1"),
         ("##", "Header 2"),
@@ -228,50 +407,249 @@ def generate_rag_db(file_path):
         for sub in sub_splits:
             sub.metadata = split.metadata  # Ensure metadata is copied
             final_splits.append(sub)
+    return final_splits
+
+def get_chunk_id(source_id, chunk_index):
+    return f"{source_id}:{chunk_index}"
+
+def get_upload_path(source_id):
+    return os.path.join(f"{st.session_state.user_dir}/uploads/", source_id)
+
+def get_source_filter(source_id):
+    """Chroma filter for all chunks of a document, chunks ingested before source_id existed only carry the file path."""
+    return {"$or": [{"source_id": source_id}, {"source": get_upload_path(source_id)}]}
+
+def add_to_rag_db(final_splits, source_id):
+    """
+    Embed the chunks of one source document and upsert them into the user's vectorstore.
+    Chunk ids are stable (source_id and position), so ingesting a document again overwrites its chunks.
+    """
+    if not final_splits:
+        print("No text chunks to add to the RAG db")
+        return
+    chunks = []
+    for chunk_index, split in enumerate(final_splits):
+        # Splits of one header section share a metadata dict, give every chunk its own.
+        metadata = dict(split.metadata)
+        metadata["source_id"] = source_id
+        metadata["chunk_index"] = chunk_index
+        chunks.append(Document(page_content=split.page_content, metadata=metadata))
 
     # embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
     embeddings = get_embedding()
     persist_dir = f"{st.session_state.user_dir}/rag_db"
+    new_vectorstore = not os.path.exists(persist_dir)
+    if new_vectorstore:
+        print(f"Creating new RAG vectorstore at: {persist_dir}")
 
-    if os.path.exists(persist_dir):
-        # Load existing vectorstore and add new documents
+    with trace_span("embedding", chunks=len(chunks), chars=sum(len(chunk.page_content) for chunk in chunks), batch_size=EMBEDDING_UPSERT_BATCH_SIZE):
         vectorstore = Chroma(persist_directory=persist_dir, embedding_function=embeddings)
-        vectorstore.add_documents(final_splits)
-    else:
-        # Create new vectorstore
-        if os.path.exists(persist_dir):
-            shutil.rmtree(persist_dir)
-        print(f"Creating new RAG vectorstore at: {persist_dir}")
-        vectorstore = Chroma.from_documents(documents=final_splits, embedding=embeddings, persist_directory=persist_dir)
+        for start in range(0, len(chunks), EMBEDDING_UPSERT_BATCH_SIZE):
+            batch = chunks[start:start + EMBEDDING_UPSERT_BATCH_SIZE]
+            # add_documents upserts by id
+            vectorstore.add_documents(batch, ids=[get_chunk_id(source_id, chunk.metadata["chunk_index"]) for chunk in batch])
+        # A revised document with fewer chunks leaves old ones behind, drop them.
+        chunk_ids = {get_chunk_id(source_id, chunk_index) for chunk_index in range(len(chunks))}
+        # Includes the random-id chunks of a version ingested before chunk ids were stable.
+        stale_ids = [chunk_id for chunk_id in vectorstore.get(where=get_source_filter(source_id), include=[])["ids"] if chunk_id not in chunk_ids]
+        if stale_ids:
+            vectorstore.delete(ids=stale_ids)
+
+    with trace_span("lexical_index", chunks=len(chunks)):
+        lexical_index.upsert_chunks(
+            st.session_state.user_dir,
+            [(get_chunk_id(source_id, chunk.metadata["chunk_index"]), source_id, chunk.metadata.get("source", ""), chunk.page_content) for chunk in chunks],
+        )
+        lexical_index.delete_chunks(st.session_state.user_dir, stale_ids)
+        if new_vectorstore:
+            # Both stores start out with the same chunks, there is nothing to backfill.
+            lexical_index.mark_backfilled(st.session_state.user_dir)
 
     st.session_state.vectorstore = vectorstore
-    return True
+    bump_index_version(st.session_state.user_dir)
 
-# Helper to get retrieved context as a single string
-def retrieve_context(query: str, max_tokens: int = 1500) -> str:
-    # Defensive checks - ensure vectorstore exists and is initialized.
+def get_vectorstore():
+    """The session's vectorstore, opened from the user's rag_db on first use. None before the first upload."""
     if not hasattr(st.session_state, 'vectorstore') or st.session_state.vectorstore is None:
         persist_dir = f"{st.session_state.user_dir}/rag_db"
-        if os.path.exists(persist_dir):
-            embeddings = get_embedding()
-            # embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-            st.session_state.vectorstore = Chroma(persist_directory=persist_dir, embedding_function=embeddings)
+        if not os.path.exists(persist_dir):
+            return None
+        embeddings = get_embedding()
+        # embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+        st.session_state.vectorstore = Chroma(persist_directory=persist_dir, embedding_function=embeddings)
+    return st.session_state.vectorstore
+
+def list_documents():
+    """Documents in the user's RAG db, as recorded in the upload manifest."""
+    return list_uploads(st.session_state.user_dir)
+
+def delete_document(source_id):
+    """Remove one document's chunks, saved files and manifest entries, leaving the rest of the RAG db alone."""
+    upload_path = get_upload_path(source_id)
+    with trace_span("delete_document", source_id=source_id) as span:
+        vectorstore = get_vectorstore()
+        if vectorstore is not None:
+            chunk_ids = vectorstore.get(where=get_source_filter(source_id), include=[])["ids"]
+            if chunk_ids:
+                vectorstore.delete(ids=chunk_ids)
+            span["attrs"]["chunks"] = len(chunk_ids)
+        lexical_index.delete_source(st.session_state.user_dir, source_id, upload_path)
+        for path in [upload_path, f"{upload_path}.md"]:
+            if os.path.exists(path):
+                os.remove(path)
+        delete_uploads(st.session_state.user_dir, source_id)
+    bump_index_version(st.session_state.user_dir)
+    print(f"Deleted document {source_id} from RAG db")
+
+def replace_document(source_id, uploaded_file):
+    """
+    Swap one document for a new version, only the new version gets converted and embedded.
+    The old document stays until the new one is ingested. Returns the ingestion outcome.
+    """
+    # Under the same name, the stable chunk ids and stale-chunk cleanup replace the old version.
+    status = process_uploaded_documents([uploaded_file]).get(uploaded_file.name)
+    if status == "SUCCESS" and uploaded_file.name != source_id:
+        delete_document(source_id)
+    return status
+
+@st.dialog("Are you sure you want to delete this document from the RAG database?")
+def delete_document_dialog(source_id):
+    st.write(source_id)
+    if st.button("Yes"):
+        delete_document(source_id)
+        st.rerun()
+
+def show_document_manager():
+    """Sidebar panel to delete or replace a single document."""
+    documents = list_documents()
+    if not documents:
+        return
+    with st.expander("Manage documents"):
+        source_id = st.selectbox("Document", [document["file_name"] for document in documents], disabled=st.session_state.disable_all)
+        if st.button("Delete document", disabled=st.session_state.disable_all):
+            delete_document_dialog(source_id)
+        replacement = st.file_uploader(
+            "Replace with a new version",
+            type=["pdf", "docx", "xlsx", "pptx", "csv", "asciidoc", "adoc", "md", "txt", "html", "htm"],
+            disabled=st.session_state.disable_all,
+        )
+        if replacement and st.button("Replace document", disabled=st.session_state.disable_all):
+            status = replace_document(source_id, replacement)
+            if status == "SUCCESS":
+                st.rerun()
+            elif status == "DUPLICATE":
+                st.warning(f"{replacement.name} is already in the RAG database, {source_id} was kept.")
+            else:
+                st.error(f"Failed to process {replacement.name}, {source_id} was kept.")
+
+def ensure_lexical_index(vectorstore):
+    """Index every vectorstore chunk in BM25 once, for RAG dbs created before the BM25 index existed."""
+    if lexical_index.is_backfilled(st.session_state.user_dir):
+        return
+    with trace_span("lexical_index", backfill=True) as span:
+        data = vectorstore.get(include=["documents", "metadatas"])
+        chunks = []
+        for chunk_id, text, metadata in zip(data["ids"], data["documents"], data["metadatas"]):
+            metadata = metadata or {}
+            source = metadata.get("source", "")
+            # Older chunks have no source_id, their file name is the one delete_document uses.
+            chunks.append((chunk_id, metadata.get("source_id", os.path.basename(source)), source, text))
+        lexical_index.upsert_chunks(st.session_state.user_dir, chunks)
+        lexical_index.mark_backfilled(st.session_state.user_dir)
+        span["attrs"]["chunks"] = len(chunks)
+
+def get_chunk_key(doc):
+    metadata = doc.metadata or {}
+    if "source_id" in metadata and "chunk_index" in metadata:
+        return get_chunk_id(metadata["source_id"], metadata["chunk_index"])
+    # Chunks ingested before stable ids existed are only in the vectorstore.
+    return doc.page_content
+
+def hybrid_search(vectorstore, query, k):
+    """Vector and BM25 search, merged by reciprocal rank fusion. Returns the best k chunks."""
+    vector_docs = vectorstore.similarity_search(query, k=RETRIEVAL_CANDIDATES)
+    ensure_lexical_index(vectorstore)
+    lexical_docs = [
+        Document(page_content=text, metadata={"source_id": source_id, "chunk_index": int(chunk_id.rsplit(":", 1)[1])} if ":" in chunk_id else {"source_id": source_id})
+        for chunk_id, source_id, text in lexical_index.search(st.session_state.user_dir, query, RETRIEVAL_CANDIDATES)
+    ]
+    scores = {}
+    docs = {}
+    for results in (vector_docs, lexical_docs):
+        for rank, doc in enumerate(results):
+            key = get_chunk_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank + 1)
+            # Prefer the vectorstore copy, it carries the full metadata.
+            docs.setdefault(key, doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    print(f"HYBRID RETRIEVAL: {len(vector_docs)} vector + {len(lexical_docs)} lexical candidates, {len(scores)} unique")
+    return [docs[key] for key in ranked[:k]]
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in SENTENCE_PATTERN.split(text) if sentence.strip()]
+
+def cosine_similarity(a, b):
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return sum(x * y for x, y in zip(a, b)) / norm if norm else 0.0
+
+def compress_context(query, context, max_tokens):
+    """
+    Keep the sentences of context that score highest against query, up to max_tokens.
+    Sentences stay in their original order. Uses the resident embedding model.
+    """
+    sentences = split_sentences(context)
+    if len(sentences) < 2:
+        return context
+    embeddings = get_embedding()
+    query_vector = embeddings.embed_query(query)
+    # Straight to the batching service, past the chunk cache: retrieved sentences are
+    # not worth keeping on disk, and the user is waiting, so they go ahead of ingestion.
+    sentence_vectors = embeddings.model.embed_documents(sentences, priority=QUERY_PRIORITY)
+    scores = [cosine_similarity(query_vector, vector) for vector in sentence_vectors]
+    kept = set()
+    used = 0
+    for index in sorted(range(len(sentences)), key=lambda i: scores[i], reverse=True):
+        tokens = count_tokens(sentences[index])
+        if used + tokens > max_tokens:
+            continue
+        kept.add(index)
+        used += tokens
+    return "\n".join(sentence for index, sentence in enumerate(sentences) if index in kept)
+
+# Helper to get retrieved context as a single string
+def retrieve_context(query: str, max_tokens: int = 1500, compress: bool = None) -> str:
+    # Defensive checks - ensure vectorstore exists and is initialized.
+    if get_vectorstore() is None:
+        st.warning("No RAG vectorstore available yet. Upload a document first to use RAG context.")
+        return ""
+
+    if compress is None:
+        compress = CONTEXT_COMPRESSION
+    user_dir = st.session_state.user_dir
+    cache_key = (user_dir, get_index_version(user_dir), normalize_query(query), RETRIEVAL_K, max_tokens, HYBRID_RETRIEVAL, compress)
+    cached = get_cached_retrieval(cache_key)
+    if cached is not None:
+        with trace_span("rag_retrieval", query_chars=len(query), k=RETRIEVAL_K, cache_hit=True, context_chars=len(cached)):
+            return cached
+
+    with trace_span("rag_retrieval", query_chars=len(query), k=RETRIEVAL_K, hybrid=HYBRID_RETRIEVAL, cache_hit=False) as span:
+        if HYBRID_RETRIEVAL:
+            relevant_docs = hybrid_search(st.session_state.vectorstore, query, RETRIEVAL_K)
         else:
-            st.warning("No RAG vectorstore available yet. Upload a document first to use RAG context.")
-            return ""
-
-    st.session_state.retriever = st.session_state.vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 4})
-
-    # relevant_docs = st.session_state.retriever.get_relevant_documents(query)
-    relevant_docs = st.session_state.retriever.invoke(query)
-    print(f"DEBUG: RAG retrieved {len(relevant_docs)} documents for query: {query}")
-    combined = "\n\n".join([doc.page_content for doc in relevant_docs])
-    # Concatenate contents; optionally truncate to keep prompts reasonable
-    # combined = "\n\n".join(doc.page_content for doc in relevant_docs if getattr(doc, 'page_content', None))
-    print(f"DEBUG: RAG combined content length: {len(combined)} characters")
-    # Rough truncation by characters (token proxy)
-    if len(combined) > max_tokens * 4:
-        combined = combined[: max_tokens * 4]
+            st.session_state.retriever = st.session_state.vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": RETRIEVAL_K})
+
+            # relevant_docs = st.session_state.retriever.get_relevant_documents(query)
+            relevant_docs = st.session_state.retriever.invoke(query)
+        # Whole chunks in relevance order, overlapping neighbours merged, up to max_tokens.
+        combined, packed_docs = pack_context(relevant_docs, max_tokens)
+        span["attrs"]["chunks"] = len(relevant_docs)
+        span["attrs"]["packed_chunks"] = len(packed_docs)
+        if compress:
+            with trace_span("context_compression", chars_in=len(combined)) as compression_span:
+                combined = compress_context(query, combined, int(count_tokens(combined) * CONTEXT_COMPRESSION_RATIO))
+                compression_span["attrs"]["chars_out"] = len(combined)
+        span["attrs"]["context_chars"] = len(combined)
+    store_retrieval(cache_key, combined)
     return combined
     # except Exception as e:
     #     print(f"RAG retrieval failed: {e}")
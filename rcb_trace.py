@@ -0,0 +1,183 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import streamlit as st
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Lightweight tracing of pipeline stages (LLM calls, retrieval, docling, TTS, ffmpeg, ...).
+# Every span is appended as one JSON line to the user's trace file:
+#   {user_dir}/traces/trace.jsonl
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "true").lower() == "true"
+# Also print every span to stdout, for debugging.
+TRACE_PRINT = os.getenv("TRACE_PRINT", "false").lower() == "true"
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(5 * 1024 * 1024)))
+# After a restart the last run is looked up in this much of the end of the trace file.
+TRACE_TAIL_BYTES = int(os.getenv("TRACE_TAIL_BYTES", str(256 * 1024)))
+
+_current_span = contextvars.ContextVar("rcb_current_span", default=None)
+_collected_spans = contextvars.ContextVar("rcb_collected_spans", default=None)
+_trace_write_lock = threading.Lock()
+# Spans of the runs still going and of the last finished run, per trace file,
+# so the sidebar waterfall doesn't have to read the trace file on every rerun.
+_open_runs = {}
+_last_runs = {}
+
+def get_trace_file() -> str:
+    """Trace file of the logged in user, or None outside of a user session."""
+    try:
+        user_dir = st.session_state.get("user_dir", "")
+    except Exception:
+        user_dir = ""
+    if not user_dir:
+        return None
+    return f"{user_dir}/traces/trace.jsonl"
+
+def _write_span(trace_file: str, span: dict):
+    os.makedirs(os.path.dirname(trace_file), exist_ok=True)
+    with _trace_write_lock:
+        # Keep one previous generation around instead of growing forever.
+        if os.path.exists(trace_file) and os.path.getsize(trace_file) > TRACE_MAX_BYTES:
+            os.replace(trace_file, f"{trace_file}.1")
+        with open(trace_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(span, ensure_ascii=False, default=str))
+            f.write("\n")
+        run_spans = _open_runs.setdefault((trace_file, span["run_id"]), [])
+        run_spans.append(span)
+        # Spans are written when they end, the root span ends its run.
+        if span.get("parent_id") is None:
+            del _open_runs[(trace_file, span["run_id"])]
+            _last_runs[trace_file] = sorted(run_spans, key=lambda run_span: run_span["start"])
+
+@contextmanager
+def trace_span(name: str, **attrs):
+    """
+    Record the duration and outcome of a pipeline stage.
+    Yields the span dict, add sizes (tokens, bytes, chunks) to span["attrs"] as they are known.
+    Spans opened inside another span share its run_id, a span without parent starts a new run.
+    """
+    parent = _current_span.get()
+    span = {
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent["span_id"] if parent else None,
+        "run_id": parent["run_id"] if parent else uuid.uuid4().hex[:16],
+        "name": name,
+        "start": time.time(),
+        "attrs": dict(attrs),
+    }
+    trace_file = parent["trace_file"] if parent else get_trace_file()
+    span["trace_file"] = trace_file
+    token = _current_span.set(span)
+    started = time.perf_counter()
+    try:
+        yield span
+        span["outcome"] = "ok"
+    except BaseException as e:
+        span["outcome"] = "error"
+        span["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        _current_span.reset(token)
+        record = {k: v for k, v in span.items() if k != "trace_file"}
+        if TRACE_PRINT:
+            print(f"TRACE: {name} {record['outcome']} {record['duration_ms']}ms {record['attrs']}")
+        collected = _collected_spans.get()
+        if collected is not None:
+            collected.append(record)
+        elif TRACE_ENABLED and trace_file:
+            try:
+                _write_span(trace_file, record)
+            except OSError as e:
+                print(f"Failed to write trace span: {e}")
+
+@contextmanager
+def collect_spans():
+    """
+    Collect the spans that finish inside the block, for work that runs without a user
+    session (e.g. in a worker process). Hand the list to record_spans in the session.
+    """
+    spans = []
+    token = _collected_spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _collected_spans.reset(token)
+
+def record_spans(spans: list):
+    """Write spans collected elsewhere into the current trace, their top-level spans under the current span."""
+    parent = _current_span.get()
+    trace_file = parent["trace_file"] if parent else get_trace_file()
+    if not TRACE_ENABLED or not trace_file or not spans:
+        return
+    run_id = parent["run_id"] if parent else uuid.uuid4().hex[:16]
+    span_ids = {span["span_id"] for span in spans}
+    try:
+        for span in spans:
+            record = dict(span, run_id=run_id)
+            if record["parent_id"] not in span_ids:
+                record["parent_id"] = parent["span_id"] if parent else None
+            _write_span(trace_file, record)
+    except OSError as e:
+        print(f"Failed to write trace span: {e}")
+
+def copy_trace_context():
+    """Snapshot of the current span, run worker functions with .run() to keep them in the same trace."""
+    return contextvars.copy_context()
+
+def load_last_run(trace_file: str) -> list:
+    """Return the spans of the most recently finished run, ordered by start time."""
+    if not trace_file:
+        return []
+    with _trace_write_lock:
+        if trace_file in _last_runs:
+            return list(_last_runs[trace_file])
+    if not os.path.exists(trace_file):
+        return []
+    # Nothing traced since the server started, read the end of the file once.
+    spans = []
+    with open(trace_file, "rb") as f:
+        f.seek(max(0, os.path.getsize(trace_file) - TRACE_TAIL_BYTES))
+        for line in f.read().decode("utf-8", errors="replace").splitlines():
+            try:
+                spans.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Including the line cut in half by the seek.
+                continue
+    # Spans are written when they end, so the last root span belongs to the last run.
+    roots = [span for span in spans if span.get("parent_id") is None]
+    last_run = []
+    if roots:
+        run_id = roots[-1]["run_id"]
+        last_run = sorted((span for span in spans if span["run_id"] == run_id), key=lambda span: span["start"])
+    with _trace_write_lock:
+        _last_runs.setdefault(trace_file, last_run)
+        return list(_last_runs[trace_file])
+
+def show_trace_waterfall():
+    """Sidebar panel with the waterfall of the last traced run."""
+    spans = load_last_run(get_trace_file())
+    if not spans:
+        return
+    run_start = min(span["start"] for span in spans)
+    run_end = max(span["start"] + span["duration_ms"] / 1000 for span in spans)
+    total = max(run_end - run_start, 0.001)
+    width = 30
+    depth = {}
+    lines = []
+    for span in spans:
+        depth[span["span_id"]] = depth.get(span["parent_id"], -1) + 1
+        offset = int((span["start"] - run_start) / total * width)
+        length = max(1, int(span["duration_ms"] / 1000 / total * width))
+        bar = " " * offset + "█" * min(length, width - offset)
+        marker = "" if span.get("outcome") == "ok" else " ✗"
+        label = "  " * depth[span["span_id"]] + span["name"]
+        lines.append(f"{label[:24]:<24} |{bar:<{width}}| {span['duration_ms'] / 1000:7.2f}s{marker}")
+    with st.sidebar.expander(f"Last run trace ({total:.1f}s)"):
+        st.code("\n".join(lines), language="text")
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+# Per-user record of ingested uploads, keyed by the sha256 of the file content:
+#   {user_dir}/uploads.db
+# Replaces the tab separated uploads-hash.txt, which is imported on first use.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def get_manifest_path(user_dir: str) -> str:
+    return f"{user_dir}/uploads.db"
+
+def _connect(user_dir: str):
+    os.makedirs(user_dir, exist_ok=True)
+    conn = sqlite3.connect(get_manifest_path(user_dir), timeout=30)
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS uploads (
+            digest TEXT PRIMARY KEY,
+            file_name TEXT NOT NULL,
+            status TEXT NOT NULL,
+            chunk_count INTEGER,
+            size INTEGER,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )"""
+    )
+    _import_legacy_hash_file(user_dir, conn)
+    return conn
+
+def _import_legacy_hash_file(user_dir: str, conn):
+    # uploads-hash.txt holds md5 digests, re-hash the saved uploads to get their sha256.
+    legacy_path = f"{user_dir}/uploads-hash.txt"
+    if not os.path.exists(legacy_path):
+        return
+    imported = 0
+    with open(legacy_path, "r") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 3:
+                continue
+            file_name, status, _ = fields
+            file_path = f"{user_dir}/uploads/{file_name}"
+            if not os.path.exists(file_path):
+                continue
+            hasher = hashlib.sha256()
+            with open(file_path, "rb") as upload:
+                for block in iter(lambda: upload.read(UPLOAD_CHUNK_SIZE), b""):
+                    hasher.update(block)
+            digest = hasher.hexdigest()
+            mtime = os.path.getmtime(file_path)
+            conn.execute(
+                "INSERT OR IGNORE INTO uploads (digest, file_name, status, chunk_count, size, created_at, updated_at) VALUES (?, ?, ?, NULL, ?, ?, ?)",
+                (digest, file_name, status, os.path.getsize(file_path), mtime, mtime),
+            )
+            imported += 1
+    conn.commit()
+    os.replace(legacy_path, f"{legacy_path}.imported")
+    print(f"Imported {imported} upload record(s) from {legacy_path}")
+
+def save_and_hash(uploaded_file, file_path: str) -> str:
+    """Write the upload to file_path in chunks, hashing it on the way. Returns the sha256 digest."""
+    hasher = hashlib.sha256()
+    uploaded_file.seek(0)
+    with open(file_path, "wb") as f:
+        for block in iter(lambda: uploaded_file.read(UPLOAD_CHUNK_SIZE), b""):
+            hasher.update(block)
+            f.write(block)
+    return hasher.hexdigest()
+
+def get_upload(user_dir: str, digest: str):
+    """Manifest entry for digest as a dict, or None if this content was never ingested."""
+    conn = _connect(user_dir)
+    try:
+        conn.row_factory = sqlite3.Row
+        row = conn.execute("SELECT * FROM uploads WHERE digest = ?", (digest,)).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+def record_upload(user_dir: str, digest: str, file_name: str, status: str, chunk_count: int = None, size: int = None):
+    now = time.time()
+    conn = _connect(user_dir)
+    try:
+        conn.execute(
+            """INSERT INTO uploads (digest, file_name, status, chunk_count, size, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(digest) DO UPDATE SET
+                   file_name = excluded.file_name,
+                   status = excluded.status,
+                   chunk_count = excluded.chunk_count,
+                   size = excluded.size,
+                   updated_at = excluded.updated_at""",
+            (digest, file_name, status, chunk_count, size, now, now),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def delete_uploads(user_dir: str, file_name: str, keep_digest: str = None):
+    """Remove the entries of file_name, except the one for keep_digest (the current version)."""
+    conn = _connect(user_dir)
+    try:
+        conn.execute("DELETE FROM uploads WHERE file_name = ? AND digest IS NOT ?", (file_name, keep_digest))
+        conn.commit()
+    finally:
+        conn.close()
+
+def list_uploads(user_dir: str) -> list:
+    """All manifest entries, oldest first."""
+    if not os.path.exists(get_manifest_path(user_dir)) and not os.path.exists(f"{user_dir}/uploads-hash.txt"):
+        return []
+    conn = _connect(user_dir)
+    try:
+        conn.row_factory = sqlite3.Row
+        return [dict(row) for row in conn.execute("SELECT * FROM uploads ORDER BY created_at")]
+    finally:
+        conn.close()